@@ -0,0 +1,225 @@
+import os
+import re
+import csv
+import time
+import signal
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+import cv2
+
+import markup
+import profiling
+from main import SOURCES, slice_scan, add_slice_args, slice_options
+
+# соглашение об именовании сканов при обходе папки: <страница>_<пол>.<расширение>,
+# например 12_1.jpg - двенадцатая страница, заполнял мужчина
+SCAN_NAME = re.compile(r'^(?P<page>\d+)_(?P<gender>[01])\.(jpe?g|png|tiff?|bmp)$', re.IGNORECASE)
+
+
+def parse_scan_name(filename):
+    """
+    Извлекает номер страницы и пол из имени файла скана
+    :param filename: имя файла без пути
+    :return: (page, gender) или None, если имя не подходит под соглашение
+    """
+    match = SCAN_NAME.match(filename)
+    if match is None:
+        return None
+    return int(match.group('page')), int(match.group('gender'))
+
+
+def read_manifest(path):
+    """
+    Читает список заданий из csv-файла со столбцами labels, images, page, gender
+    :param path: путь к манифесту
+    :return: список кортежей (labels, images, page, gender)
+    """
+    tasks = []
+    with open(path, newline='', encoding='utf-8') as file:
+        for row in csv.DictReader(file):
+            tasks.append((row['labels'], row['images'], int(row['page']), int(row['gender'])))
+    return tasks
+
+
+def walk_images(root='./data/images', sources=SOURCES):
+    """
+    Собирает задания обходом папки data/images/<source>/
+    :param root: папка с исходными (сканированными) изображениями
+    :param sources: какие подпапки обходить
+    :return: (список заданий, список файлов с неподходящими именами)
+    """
+    tasks, skipped = [], []
+    for source in sources:
+        folder = os.path.join(root, source)
+        if not os.path.isdir(folder):
+            continue
+        for filename in sorted(os.listdir(folder)):
+            parsed = parse_scan_name(filename)
+            if parsed is None:
+                skipped.append(os.path.join(folder, filename))
+            else:
+                tasks.append((source, filename) + parsed)
+    return tasks, skipped
+
+
+def init_worker(cv_threads):
+    """
+    Инициализация процесса пула (initializer ProcessPoolExecutor), общая для batch.py и watch.py
+    :param cv_threads: число потоков opencv в процессе
+    """
+    # каждый процесс пула получает свой лимит потоков opencv,
+    # иначе процессы и внутренние потоки opencv делят одни и те же ядра
+    cv2.setNumThreads(cv_threads)
+    # Ctrl+C получает вся группа процессов: останавливает пул только главный процесс,
+    # а начатые сканы дописываются, иначе future.result() выбрасывает KeyboardInterrupt процесса пула
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def run_one(task, options, profile):
+    """
+    Нарезка одного скана в процессе пула: ошибка скана возвращается, а не выбрасывается
+    :param task: кортеж (labels, images, page, gender)
+    :param options: параметры нарезки для slice_scan
+    :param profile: собирать замеры этапов
+    :return: (задание, замечания автоматической проверки, ошибка или None, замеры этапов)
+    """
+    # замеры делаются в процессе пула и возвращаются вместе с результатом
+    profiler = profiling.Profiler() if profile else None
+    try:
+        # csv разметки выгружается один раз после всей пачки, а не каждым процессом
+        n_cells, issues = slice_scan(*task, nocheck=True, profiler=profiler, export=False, **options)
+        return task, issues, None, profiler.rows() if profiler else []
+    except Exception as e:  # ошибка одного скана не должна останавливать всю пачку
+        return task, [], '%s: %s' % (type(e).__name__, e), profiler.rows() if profiler else []
+
+
+def run_batch(tasks, workers=None, cv_threads=1, profiler=None, **options):
+    """
+    Параллельная нарезка множества сканов на пуле процессов
+    :param tasks: список кортежей (labels, images, page, gender)
+    :param workers: число процессов (по умолчанию - по числу ядер)
+    :param cv_threads: число потоков opencv в каждом процессе
+    :param profiler: profiling.Profiler, в который собираются замеры этапов всех сканов
+    :param options: параметры нарезки, передаваемые в slice_scan (backend, levels, templates, cache)
+    :return: (количество успешно нарезанных сканов, список (задание, ошибка),
+             список (задание, замечания автоматической проверки) для подозрительных сканов)
+    """
+    workers = workers or os.cpu_count() or 1
+    done, failures, flagged = 0, [], []
+    sources = set()  # источники, разметка которых пополнилась
+    results = []
+    start = time.perf_counter()
+    todo = deque(tasks)
+    running = {}  # future -> задание
+    pool = ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(cv_threads,))
+
+    def collect(finished):
+        broken = False
+        for future in finished:
+            task = running.pop(future)
+            try:
+                results.append(future.result())
+            except BrokenProcessPool as e:  # процесс пула погиб (segfault в opencv, OOM)
+                results.append((task, [], '%s: %s' % (type(e).__name__, e), []))
+                broken = True
+        return broken
+
+    try:
+        while todo or running:
+            # в пуле одновременно не больше workers заданий: если процесс пула погибнет,
+            # упавшими считаются только они, а остальные задания уйдут в новый пул
+            broken = False
+            while todo and len(running) < workers:
+                try:
+                    future = pool.submit(run_one, todo[0], options, profiler is not None)
+                except BrokenProcessPool:
+                    broken = True
+                    break
+                running[future] = todo.popleft()
+            if running:
+                finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                broken |= collect(finished)
+            if broken:
+                print("Процесс пула аварийно завершился, пул запускается заново")
+                pool.shutdown(wait=False, cancel_futures=True)
+                collect(wait(list(running))[0])
+                pool = ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(cv_threads,))
+    except KeyboardInterrupt:
+        # еще не начатые задания не запускаются, начатые дописываются (процессы пула Ctrl+C игнорируют)
+        print("Прервано, дожидаемся сканов в работе")
+        collect(wait(list(running))[0])
+    finally:
+        pool.shutdown()
+    for task, issues, error, records in results:
+        if profiler is not None:
+            profiler.extend(records)
+        if error is None:
+            done += 1
+            sources.add(task[0])
+            if issues:
+                flagged.append((task, issues))
+        else:
+            failures.append((task, error))
+            print("Ошибка: %s/%s - %s" % (task[0], task[1], error))
+    for source in sorted(sources):
+        markup.export_markup(source)
+    elapsed = time.perf_counter() - start
+    rate = len(tasks) / elapsed if elapsed > 0 else 0.0
+    print("Обработано сканов: %d из %d за %.1f с (%.2f скан/с), ошибок: %d, подозрительных: %d"
+          % (done, len(tasks), elapsed, rate, len(failures), len(flagged)))
+    return done, failures, flagged
+
+
+def write_qa_report(path, flagged, append=False):
+    """
+    Отчет автоматической проверки: по строке на каждое замечание
+    :param path: путь к csv-файлу
+    :param flagged: список (задание, замечания) из run_batch
+    :param append: дописать в существующий отчет (демон watch.py пишет его по мере нарезки)
+    """
+    new_file = not append or not os.path.exists(path) or os.path.getsize(path) == 0
+    with open(path, 'w' if not append else 'a', newline='', encoding='utf-8') as file:
+        writer = csv.writer(file)
+        if new_file:
+            writer.writerow(('labels', 'images', 'page', 'gender', 'issue'))
+        for task, issues in flagged:
+            for issue in issues:
+                writer.writerow(task + (issue,))
+
+
+if __name__ == '__main__':
+    # интерпретатор должен быть запущен в корневой папке проекта!
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--manifest", help='csv со столбцами labels,images,page,gender. '
+                                           'Если не указан - обходится папка data/images/<source>/')
+    parser.add_argument("--sources", nargs='+', choices=SOURCES, default=SOURCES,
+                        help='Какие подпапки data/images обходить')
+    parser.add_argument("-j", "--workers", type=int, default=None, help="Число процессов (по умолчанию - по числу ядер)")
+    parser.add_argument("--cv-threads", type=int, default=1, help="Число потоков opencv в каждом процессе")
+    add_slice_args(parser)
+    parser.add_argument("--profile", default=None,
+                        help="Замерить время и память по этапам каждого скана, отчет в json или csv")
+    parser.add_argument("--qa-report", default='qa_report.csv',
+                        help="Куда записать замечания автоматической проверки сканов")
+    args = parser.parse_args()
+
+    if args.manifest:
+        tasks = read_manifest(args.manifest)
+    else:
+        tasks, skipped = walk_images(sources=args.sources)
+        for path in skipped:
+            print("Пропущен (имя не в формате <страница>_<пол>): %s" % path)
+
+    profiler = profiling.Profiler(enabled=False) if args.profile else None
+    done, failures, flagged = run_batch(tasks, args.workers, args.cv_threads, profiler, **slice_options(args))
+    if flagged:
+        write_qa_report(args.qa_report, flagged)
+        print("Замечания проверки записаны в %s" % args.qa_report)
+    if profiler is not None:
+        profiler.write(args.profile)
+        profiler.print_summary()
+    if failures:
+        raise SystemExit(1)
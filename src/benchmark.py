@@ -0,0 +1,124 @@
+import os
+import json
+import time
+import argparse
+import subprocess
+import tempfile
+
+import cell_grid
+import profiling
+import synth
+import table_slice as ts
+
+# варианты бланков: чистый, повернутый с бледными линиями, сильно зашумленный
+VARIANTS = {
+    'clean': {'angle': 0.0, 'line_gray': 0, 'noise': 2.0},
+    'rotated_faint': {'angle': 0.7, 'line_gray': 110, 'noise': 6.0},
+    'noisy': {'angle': -0.4, 'line_gray': 60, 'noise': 18.0},
+}
+
+
+def _commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def run(dpis=(200, 300, 400, 600), repeat=3, backend='legacy', levels=0):
+    """
+    Замер этапов нарезки на синтетических бланках и сверка найденных ячеек с истинными
+    :param dpis: разрешения сканов
+    :param repeat: сколько бланков каждого варианта обрабатывать
+    :param backend: способ разбора сетки ячеек
+    :param levels: число уровней пирамиды при поиске линий
+    :return: список результатов по каждому разрешению и варианту бланка
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:  # сюда пишутся контрольные мозаики
+        for dpi in dpis:
+            for variant, params in VARIANTS.items():
+                prof = profiling.Profiler(memory=False)
+                accuracy = []
+                for seed in range(repeat):
+                    img, truth = synth.render_form(dpi, seed=seed, **params)
+                    prof.scan('%d/%s/%d' % (dpi, variant, seed))
+                    with prof.stage('binarize'):
+                        img_bin = ts.binarize(img)
+                    with prof.stage('get_lines'):
+                        img_vh, bitnot = ts.get_lines(img, img_bin, levels)
+                    try:
+                        with prof.stage('get_images') as stage:
+                            cells = ts.get_cells(img_vh, img_bin, backend)
+                            # печатные ячейки не обрабатываются, как и в main.py
+                            crops = ts.crop_cells(bitnot, cells[cell_grid.cell_roles(cells) == cell_grid.HANDWRITTEN])
+                            stage.cells = len(crops)
+                        with prof.stage('control'):
+                            ts.control([''] * len(crops), crops, nocheck=True,
+                                       path=os.path.join(workdir, 'control.png'))
+                    except Exception as e:  # ошибка разбора - тоже результат бенчмарка
+                        accuracy.append({'matched': 0, 'truth': len(truth), 'extra': 0, 'max_error': None,
+                                         'error': '%s: %s' % (type(e).__name__, e)})
+                        continue
+                    accuracy.append(synth.match_boxes(cells, truth))
+                results.append({
+                    'dpi': dpi, 'variant': variant, 'shape': list(img.shape),
+                    'stages': {name: {k: s[k] for k in ('mean', 'p50', 'p90')} for name, s in prof.summary().items()},
+                    'matched': sum(a['matched'] for a in accuracy), 'truth': sum(a['truth'] for a in accuracy),
+                    'extra': sum(a['extra'] for a in accuracy),
+                    'max_error': max((a['max_error'] for a in accuracy if a['max_error'] is not None), default=None),
+                    'errors': [a['error'] for a in accuracy if 'error' in a],
+                })
+    return results
+
+
+def compare(results, baseline):
+    """
+    Печатает отношение времени этапов к сохраненному ранее прогону
+    :param results: текущие результаты
+    :param baseline: результаты, с которыми сравниваем
+    """
+    old = {(r['dpi'], r['variant']): r for r in baseline['results']}
+    print("Сравнение с %s (%s): время сейчас / время тогда" % (baseline['commit'], baseline['date']))
+    for r in results:
+        prev = old.get((r['dpi'], r['variant']))
+        if prev is None:
+            continue
+        ratios = ['%s %.2f' % (name, s['p50'] / prev['stages'][name]['p50'])
+                  for name, s in r['stages'].items() if prev['stages'].get(name, {}).get('p50')]
+        print("%4d dpi %-14s %s" % (r['dpi'], r['variant'], ', '.join(ratios)))
+
+
+if __name__ == '__main__':
+    # интерпретатор должен быть запущен в корневой папке проекта!
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dpi", type=int, nargs='+', default=[200, 300, 400, 600], help='Разрешения сканов')
+    parser.add_argument("-n", "--repeat", type=int, default=3, help='Бланков на каждый вариант')
+    parser.add_argument("--backend", choices=['legacy', 'grid'], default='legacy', help='Способ разбора сетки')
+    parser.add_argument("--levels", type=int, default=0, help='Уровни пирамиды при поиске линий (без повтора в полном разрешении, как в pipeline)')
+    parser.add_argument("-o", "--output", default='./bench', help='Папка для сохранения результатов')
+    parser.add_argument("--compare", help='json предыдущего прогона для сравнения')
+    args = parser.parse_args()
+
+    results = run(args.dpi, args.repeat, args.backend, args.levels)
+    for r in results:
+        stages = ', '.join('%s %.4f' % (name, s['p50']) for name, s in r['stages'].items())
+        print("%4d dpi %-14s ячеек %d/%d, лишних %d, макс. ошибка %s | %s"
+              % (r['dpi'], r['variant'], r['matched'], r['truth'], r['extra'], r['max_error'], stages))
+        for error in r['errors']:
+            print("    ошибка: %s" % error)
+
+    report = {'commit': _commit(), 'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+              'params': {'backend': args.backend, 'levels': args.levels, 'repeat': args.repeat},
+              'results': results}
+    if not os.path.exists(args.output):
+        os.makedirs(args.output)
+    path = os.path.join(args.output, 'bench_%s_%s.json' % (time.strftime('%Y%m%d_%H%M%S'), report['commit']))
+    with open(path, 'w', encoding='utf-8') as file:
+        json.dump(report, file, ensure_ascii=False, indent=1)
+    print("Результаты сохранены в %s" % path)
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as file:
+            compare(results, json.load(file))
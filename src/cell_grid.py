@@ -0,0 +1,124 @@
+import os
+import json
+
+import numpy as np
+
+# столбцы массива ячеек, который возвращает build_grid
+ROW, COL, X, Y, W, H = range(6)
+# роли ячеек бланка: печатный образец и рукописный ответ
+PRINTED, HANDWRITTEN = 'printed', 'handwritten'
+# описание ячеек скана, лежит в папке с нарезанными изображениями
+LAYOUT_FILE = 'cells.json'
+
+
+def _clusters(values, tol):
+    """
+    Разбивает отсортированные значения на группы: новая группа начинается там,
+    где разрыв между соседними значениями больше tol
+    :param values: отсортированный одномерный массив
+    :param tol: допустимый разрыв внутри группы
+    :return: номер группы для каждого значения
+    """
+    labels = np.zeros(len(values), dtype=int)
+    if len(values) > 1:
+        labels[1:] = np.cumsum(np.diff(values) > tol)
+    return labels
+
+
+def build_grid(boxes, row_tol=None, col_tol=None):
+    """
+    Восстанавливает сетку таблицы по прямоугольникам ячеек без циклов по ячейкам
+    Строки - группы близких верхних границ, столбцы - группы близких левых границ,
+    поэтому строки с пропущенными ячейками не ломают разбор, а объединенная ячейка
+    относится к столбцу своей левой границы
+    :param boxes: массив (N, 4) из x, y, w, h
+    :param row_tol: допуск по вертикали (по умолчанию - половина медианной высоты ячейки)
+    :param col_tol: допуск по горизонтали (по умолчанию - половина медианной ширины ячейки)
+    :return: массив int (N, 6) из row, col, x, y, w, h, упорядоченный по строкам, затем по столбцам
+    """
+    boxes = np.asarray(boxes, dtype=int).reshape(-1, 4)
+    if len(boxes) == 0:
+        return np.empty((0, 6), dtype=int)
+    if row_tol is None:
+        row_tol = np.median(boxes[:, 3]) / 2
+    if col_tol is None:
+        col_tol = np.median(boxes[:, 2]) / 2
+
+    rows = np.empty(len(boxes), dtype=int)
+    order = np.argsort(boxes[:, 1], kind='stable')
+    rows[order] = _clusters(boxes[order, 1], row_tol)
+
+    cols = np.empty(len(boxes), dtype=int)
+    order = np.argsort(boxes[:, 0], kind='stable')
+    cols[order] = _clusters(boxes[order, 0], col_tol)
+
+    cells = np.column_stack((rows, cols, boxes))
+    # lexsort сортирует по последнему ключу в первую очередь
+    order = np.lexsort((cells[:, X], cells[:, Y], cells[:, COL], cells[:, ROW]))
+    return cells[order]
+
+
+def is_complete(cells, shape):
+    """
+    Найдена ли сетка бланка целиком: shape[0] строк по shape[1] ячеек, без пропусков и лишних ячеек
+    :param cells: массив (N, 6) из row, col, x, y, w, h
+    :param shape: (строк, столбцов) бланка
+    """
+    cells = np.asarray(cells, dtype=int).reshape(-1, 6)
+    rows, cols = shape
+    if len(cells) != rows * cols:
+        return False
+    # каждая пара (строка, столбец) встречается ровно один раз
+    return len(set(zip(cells[:, ROW], cells[:, COL]))) == rows * cols \
+        and cells[:, ROW].max() == rows - 1 and cells[:, COL].max() == cols - 1
+
+
+def cell_roles(cells, printed_cols=(0,)):
+    """
+    Роль каждой ячейки по столбцу сетки: в столбцах printed_cols печатный образец,
+    в остальных - рукописный ответ
+    :param cells: массив (N, 6) из row, col, x, y, w, h
+    :param printed_cols: номера столбцов с печатным текстом
+    :return: массив строк (N,) со значениями PRINTED или HANDWRITTEN
+    """
+    cells = np.asarray(cells, dtype=int).reshape(-1, 6)
+    return np.where(np.isin(cells[:, COL], printed_cols), PRINTED, HANDWRITTEN)
+
+
+def write_layout(folder, cells, roles, files):
+    """
+    Записывает описание ячеек скана (строка, столбец, роль, рамка, имя файла) в LAYOUT_FILE
+    :param folder: папка с нарезанными изображениями скана
+    :param cells: массив (N, 6) из row, col, x, y, w, h
+    :param roles: роли ячеек (как возвращает cell_roles)
+    :param files: имена записанных файлов по ячейкам (None - ячейка не записывалась)
+    """
+    layout = [{'row': int(c[ROW]), 'col': int(c[COL]), 'role': str(role),
+               'bbox': [int(v) for v in c[X:]], 'file': file}
+              for c, role, file in zip(np.asarray(cells, dtype=int).reshape(-1, 6), roles, files)]
+    path = os.path.join(folder, LAYOUT_FILE)
+    tmp_path = path + '.%d.tmp' % os.getpid()
+    with open(tmp_path, 'w', encoding='utf-8') as file:
+        json.dump(layout, file, indent=1)
+    os.replace(tmp_path, path)
+
+
+def read_layout(folder):
+    """
+    :param folder: папка с нарезанными изображениями скана
+    :return: список описаний ячеек в порядке нарезки (см. write_layout)
+    """
+    path = os.path.join(folder, LAYOUT_FILE)
+    try:
+        with open(path, encoding='utf-8') as file:
+            return json.load(file)
+    except OSError:
+        raise Exception("Нет описания ячеек %s, скан нужно нарезать заново" % path)
+
+
+def handwritten_files(folder):
+    """
+    :param folder: папка с нарезанными изображениями скана
+    :return: имена файлов рукописных ячеек в порядке строк таблицы
+    """
+    return [cell['file'] for cell in read_layout(folder) if cell['role'] == HANDWRITTEN]
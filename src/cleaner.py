@@ -1,16 +1,34 @@
 import os
+import re
+
+import cell_grid
+
+# нарезанная ячейка: номер ячейки в таблице, как его пишет pipeline.JpegFolderSink
+CROP_FILE = re.compile(r'^(\d{3})\.jpg$')
 
 
 def cleaner(folder):
     """
     :param folder: папка, где чистим
     Функция убирает изображения с печатным текстом из папки с нерезанными изображениями
+    Печатные ячейки больше не записываются, но могли остаться от прежних запусков:
+    их номера берутся из описания ячеек скана (cell_grid.LAYOUT_FILE)
     """
     for folder, subfolder, filelist in os.walk(folder):
-        if len(filelist) > 1:
-            for file in filelist:
-                if int(file[:3]) % 2 == 0:
-                    os.remove(os.path.join(folder, file))
+        if cell_grid.LAYOUT_FILE in filelist:
+            printed = {idx for idx, cell in enumerate(cell_grid.read_layout(folder))
+                       if cell['role'] == cell_grid.PRINTED}
+        elif len(filelist) > 1:
+            # папки, нарезанные до появления описания: печатные ячейки - четные номера
+            printed = set(range(0, 1000, 2))
+        else:
+            continue
+        for file in filelist:
+            # кроме нарезанных ячеек (NNN.jpg) в папках бывают контрольные мозаики
+            # (<страница>_<пол>_control.png), их имена тоже начинаются с цифр
+            match = CROP_FILE.match(file)
+            if match and int(match.group(1)) in printed:
+                os.remove(os.path.join(folder, file))
 
 
 if __name__ == '__main__':
@@ -1,62 +1,227 @@
 import os
-import numpy as np
+import json
+import hashlib
+import time
+import itertools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
 import cv2
+import numpy as np
 
-from src import markup
+import cell_grid
+import enhance
+import markup
 
 
 class DataProvider:
 
-    def __init__(self, labels_file, image_folder, preprocess=False):
-        self.labels = markup.read_source(labels_file)
+    def __init__(self, labels_file, image_folder, preprocess=False, page=1,
+                 workers=0, prefetch=16, batch_size=None, height=None):
+        """
+        :param labels_file: csv-файл с текстами
+        :param image_folder: папка с нарезанными изображениями одного скана
+        :param preprocess: дополнительно обработать изображения (preprocess_image)
+        :param page: номер страницы в csv-файле, соответствующей скану
+        :param workers: число потоков предзагрузки (0 - читать в вызывающем потоке)
+        :param prefetch: сколько изображений может быть загружено заранее
+        :param batch_size: отдавать пачки: (массив uint8 (N, H, W), список текстов)
+        :param height: привести изображения к этой высоте (с сохранением пропорций)
+        """
+        self.labels = markup.read_source(labels_file, page)
         self.preprocess = preprocess
-        image_list = os.listdir(image_folder)
-        self.images = [os.path.join(image_folder, file) for idx, file in enumerate(image_list) if idx % 2 == 1]
+        self.images = [os.path.join(image_folder, file) for file in cell_grid.handwritten_files(image_folder)]
+        self.workers = workers
+        self.prefetch = max(1, prefetch)
+        self.batch_size = batch_size
+        self.height = height
+        self.wait_times = []  # сколько потребитель ждал каждое изображение (или пачку), в секундах
+
+    def _load(self, img_file):
+        img = cv2.imread(img_file, cv2.IMREAD_GRAYSCALE)
+        if self.preprocess:
+            img = preprocess_image(img)
+        if self.height:
+            width = max(1, round(img.shape[1] * self.height / img.shape[0]))
+            img = cv2.resize(img, (width, self.height), interpolation=cv2.INTER_AREA)
+        return img
+
+    def _prefetched(self):
+        # изображения грузятся пулом потоков, но отдаются строго в порядке текстов;
+        # в очереди одновременно не больше prefetch заданий
+        pairs = zip(self.labels, self.images)
+        if not self.workers:
+            for lbl, img_file in pairs:
+                start = time.perf_counter()
+                img = self._load(img_file)
+                yield lbl, img, time.perf_counter() - start
+            return
+
+        pool = ThreadPoolExecutor(max_workers=self.workers)
+        try:
+            pending = deque((lbl, pool.submit(self._load, img_file))
+                            for lbl, img_file in itertools.islice(pairs, self.prefetch))
+            while pending:
+                lbl, future = pending.popleft()
+                start = time.perf_counter()
+                img = future.result()
+                waited = time.perf_counter() - start
+                for next_lbl, img_file in itertools.islice(pairs, 1):
+                    pending.append((next_lbl, pool.submit(self._load, img_file)))
+                yield lbl, img, waited
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
 
     def __iter__(self):
-        for lbl, img_file in zip(self.labels, self.images):
-            img = cv2.imread(img_file, cv2.IMREAD_GRAYSCALE)
-            if self.preprocess:
-                img = preprocess_image(img)
-            yield lbl, img
+        if not self.batch_size:
+            for lbl, img, waited in self._prefetched():
+                self.wait_times.append(waited)
+                yield lbl, img
+            return
+
+        batch, waited_total = [], 0.0
+        for lbl, img, waited in self._prefetched():
+            batch.append((lbl, img))
+            waited_total += waited
+            if len(batch) == self.batch_size:
+                self.wait_times.append(waited_total)
+                yield pad_batch([img for lbl, img in batch]), [lbl for lbl, img in batch]
+                batch, waited_total = [], 0.0
+        if batch:
+            self.wait_times.append(waited_total)
+            yield pad_batch([img for lbl, img in batch]), [lbl for lbl, img in batch]
+
+
+def pad_batch(images, value=255):
+    """
+    Собирает изображения в один массив, дополняя их белым фоном справа и снизу
+    :param images: список изображений uint8
+    :param value: цвет фона
+    :return: массив uint8 (N, H, W)
+    """
+    height = max(img.shape[0] for img in images)
+    width = max(img.shape[1] for img in images)
+    batch = np.full((len(images), height, width), value, dtype=np.uint8)
+    for i, img in enumerate(images):
+        batch[i, :img.shape[0], :img.shape[1]] = img
+    return batch
 
 
 def preprocess_image(img):
-    # увеличит контраст
-    pxmin = np.min(img)
-    pxmax = np.max(img)
-    imgContrast = (img - pxmin) / (pxmax - pxmin) * 255
+    # увеличит контраст и толщину линий (uint8, та же обработка, что и при нарезке)
+    return enhance.increase_contrast(img)
+
 
-    # увеличить толщину линий
-    kernel = np.ones((3, 3), np.uint8)
-    imgMorph = cv2.erode(imgContrast, kernel, iterations=1)
-    return imgMorph
+def _write_png(path, image, compression):
+    # файл появляется под своим именем только целиком записанным
+    ok, buf = cv2.imencode('.png', image, [cv2.IMWRITE_PNG_COMPRESSION, compression])
+    if not ok:
+        raise Exception("Не удалось закодировать %s" % path)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as file:
+        file.write(buf.data)
+    os.replace(tmp_path, path)
 
 
-def createIAMCompatibleDataset(data_provider):
+def _fingerprint(data_provider):
     """
-    this function converts the passed dataset to an IAM compatible dataset
+    Отпечаток источника: хэш текстов и путей к изображениям (как у DataProvider)
+    :return: строка или None, если источник не описывает свое содержимое
     """
+    labels, images = getattr(data_provider, 'labels', None), getattr(data_provider, 'images', None)
+    if labels is None or images is None:
+        return None
+    return hashlib.sha1(json.dumps([list(labels), list(images)], ensure_ascii=False).encode('utf-8')).hexdigest()
 
-    # подготовка файло и директорий
-    f = open('../words.txt', 'w+')
-    if not os.path.exists('../sub'):
-        os.makedirs('../sub')
-    if not os.path.exists('../sub/sub-sub'):
-        os.makedirs('../sub/sub-sub')
 
-    # конвертация данных в IAM-совместимый формат
-    cnt = 0
-    for label, image in data_provider:
+def _save_checkpoint(path, count, words_bytes, fingerprint=None):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as file:
+        json.dump({'count': count, 'words_bytes': words_bytes, 'fingerprint': fingerprint}, file)
+    os.replace(tmp_path, path)
 
-        # write img
-        cv2.imwrite('sub/sub-sub/sub-sub-%d.png' % cnt, image)
 
-        # write filename, dummy-values and text
-        line = 'sub-sub-%d' % cnt + ' X X X X X X X ' + label + '\n'
-        f.write(line)
+def createIAMCompatibleDataset(data_provider, out_dir='..', workers=4, compression=3, resume=False,
+                               checkpoint_every=100):
+    """
+    this function converts the passed dataset to an IAM compatible dataset
+    Изображения кодируются в png пулом потоков, а words.txt пишется в исходном порядке.
+    Прогресс сохраняется в export.ckpt, и прерванная конвертация того же источника
+    (с тем же отпечатком текстов и путей) продолжается с последнего зафиксированного образца.
+    После успешной конвертации export.ckpt удаляется
+    :param data_provider: источник пар (текст, изображение)
+    :param out_dir: папка, куда пишутся words.txt и sub/sub-sub/
+    :param workers: число потоков кодирования
+    :param compression: уровень сжатия png (0-9)
+    :param resume: продолжить прерванную конвертацию того же источника
+                   (по умолчанию, как и раньше, words.txt пишется заново)
+    :param checkpoint_every: как часто (в образцах) сохранять прогресс
+    :return: количество образцов в наборе
+    """
 
-        cnt += 1
+    # подготовка файло и директорий
+    words_path = os.path.join(out_dir, 'words.txt')
+    ckpt_path = os.path.join(out_dir, 'export.ckpt')
+    img_dir = os.path.join(out_dir, 'sub', 'sub-sub')
+    if not os.path.exists(img_dir):
+        os.makedirs(img_dir)
+
+    cnt, words_bytes = 0, 0
+    fingerprint = _fingerprint(data_provider)
+    if resume and os.path.exists(ckpt_path) and os.path.exists(words_path):
+        with open(ckpt_path) as file:
+            ckpt = json.load(file)
+        # контрольная точка другого источника не подходит (иначе первые образцы нового источника
+        # были бы пропущены), как и точка от другого words.txt (замененного или укороченного):
+        # truncate дополнил бы файл нулевыми байтами
+        if fingerprint is None or ckpt.get('fingerprint') != fingerprint:
+            print("Контрольная точка %s относится к другому источнику, конвертация начинается заново" % ckpt_path)
+        elif ckpt['words_bytes'] > os.path.getsize(words_path):
+            print("Контрольная точка %s не соответствует %s, конвертация начинается заново" % (ckpt_path, words_path))
+        else:
+            cnt, words_bytes = ckpt['count'], ckpt['words_bytes']
+    # строки, дописанные после последней контрольной точки, отбрасываем
+    with open(words_path, 'a') as f:
+        f.truncate(words_bytes)
+    # при новой конвертации старая контрольная точка сразу сбрасывается
+    _save_checkpoint(ckpt_path, cnt, words_bytes, fingerprint)
+    committed = cnt
+
+    # конвертация данных в IAM-совместимый формат
+    samples = itertools.islice(iter(data_provider), cnt, None)
+    with open(words_path, 'a') as f, ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+
+        def commit():
+            nonlocal committed
+            n, label, future = pending.popleft()
+            future.result()  # ошибка кодирования останавливает конвертацию до фиксации образца
+            # write filename, dummy-values and text
+            f.write('sub-sub-%d' % n + ' X X X X X X X ' + label + '\n')
+            committed = n + 1
+            if committed % checkpoint_every == 0:
+                checkpoint()
+
+        def checkpoint():
+            f.flush()
+            os.fsync(f.fileno())
+            _save_checkpoint(ckpt_path, committed, os.path.getsize(words_path), fingerprint)
+
+        for label, image in samples:
+            # write img
+            path = os.path.join(img_dir, 'sub-sub-%d.png' % cnt)
+            pending.append((cnt, label, pool.submit(_write_png, path, image, compression)))
+            cnt += 1
+            # ограничиваем число изображений в памяти и фиксируем готовые по порядку
+            while len(pending) > 2 * workers or (pending and pending[0][2].done()):
+                commit()
+        while pending:
+            commit()
+        f.flush()
+        os.fsync(f.fileno())
+    # конвертация завершена: продолжать нечего
+    os.remove(ckpt_path)
+    return committed
 
 
 if __name__ == '__main__':
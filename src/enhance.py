@@ -0,0 +1,74 @@
+import cv2
+import numpy as np
+
+# ядро утолщения линий (эрозия светлого фона)
+ERODE_KERNEL = np.ones((3, 3), np.uint8)
+
+
+def contrast_lut(img):
+    """
+    Таблица растяжения контраста на 256 значений
+    Значения совпадают с тем, что давала формула (img - pxmin) / (pxmax - pxmin) * 255
+    после округления при записи в uint8 (к ближайшему четному, как cvRound)
+    :param img: изображение uint8
+    :return: таблица uint8 (256,)
+    """
+    pxmin, pxmax = cv2.minMaxLoc(img)[:2]
+    if pxmax == pxmin:
+        # формула дает 0 / 0 = nan, который opencv при записи превращает в 0
+        return np.zeros(256, dtype=np.uint8)
+    values = (np.arange(256, dtype=np.float64) - pxmin) / (pxmax - pxmin) * 255
+    return np.rint(np.clip(values, 0, 255)).astype(np.uint8)
+
+
+class Enhancer:
+    """
+    Растяжение контраста, утолщение линий и добавление полей за один проход по uint8
+    Промежуточные и выходной массивы переиспользуются между вызовами, поэтому
+    результат действителен только до следующего вызова (для хранения - копировать)
+    """
+
+    def __init__(self, erode=True, pad=0):
+        """
+        :param erode: утолщать линии (эрозия ядром 3x3)
+        :param pad: ширина белых полей вокруг изображения
+        """
+        self.erode = erode
+        self.pad = pad
+        self._buffers = [np.empty(0, dtype=np.uint8), np.empty(0, dtype=np.uint8)]
+
+    def _buffer(self, i, shape):
+        size = shape[0] * shape[1]
+        if self._buffers[i].size < size:
+            self._buffers[i] = np.empty(size, dtype=np.uint8)
+        return self._buffers[i][:size].reshape(shape)
+
+    def __call__(self, img):
+        """
+        :param img: исходное изображение uint8
+        :return: обработанное изображение uint8 (вид на внутренний буфер)
+        """
+        lut = contrast_lut(img)
+        p = self.pad
+        shape = (img.shape[0] + 2 * p, img.shape[1] + 2 * p)
+        src = img
+        if p:
+            # поля не темнее исходного максимума: после растяжения они белые
+            # и не влияют на эрозию у краев
+            src = cv2.copyMakeBorder(img, p, p, p, p, cv2.BORDER_CONSTANT, value=255,
+                                     dst=self._buffer(0, shape))
+        if self.erode:
+            # эрозия перестановочна с монотонной таблицей, поэтому выполняется до нее, на uint8
+            src = cv2.erode(src, ERODE_KERNEL, dst=self._buffer(1, shape), iterations=1)
+        return cv2.LUT(src, lut, dst=self._buffer(0, shape))
+
+
+def increase_contrast(img, erode=True, pad=0):
+    """
+    Увеличивает контрастность и толщину линий для улучшения качества распознавания
+    :param img: исходное изображение uint8
+    :param erode: утолщать линии
+    :param pad: ширина белых полей вокруг изображения
+    :return: обработанное изображение uint8 (новый массив)
+    """
+    return Enhancer(erode, pad)(img).copy()
@@ -1,59 +1,153 @@
 import os
 import argparse
 
-import cv2
-
+import cell_grid
 import markup
-import table_slice as ts
+import pipeline
+import profiling
+import slice_cache as sc
+
+# допустимые имена файлов с текстами (data/labels/<source>.csv)
+SOURCES = ['blvrd', 'discipl', 'econ', 'journ', 'koms', 'mathstat']
+
+
+def slice_scan(labels, images, page, gender, nocheck=False, backend='legacy', levels=0, templates=None,
+               cache=None, profiler=None, export=True):
+    """
+    Нарезка одного скана и формирование разметки для него
+    :param labels: название файла с текстом (без расширения)
+    :param images: имя файла с отсканированным изображением (без пути)
+    :param page: номер страницы
+    :param gender: пол заполнившего лист
+    :param nocheck: не запрашивать подтверждение записи
+    :param backend: способ разбора сетки ячеек ('legacy' или 'grid')
+    :param levels: число уровней пирамиды при поиске линий таблицы (0 - полное разрешение)
+    :param templates: папка реестра бланков. Если указана, сетка ячеек берется из подходящего
+                      шаблона, а поиск контуров выполняется только для новых макетов
+    :param cache: папка кэша нарезки. Если указана, повторный запуск на том же скане с теми же
+                  параметрами не режет его заново и не перезаписывает неизменившиеся файлы
+    :param profiler: profiling.Profiler для замера этапов обработки (по умолчанию замеров нет)
+    :param export: сразу выгрузить markup/markup_<labels>.csv из хранилища разметки
+                   (при пакетной обработке выгрузка делается один раз в конце)
+    :return: (количество рукописных ячеек, список замечаний автоматической проверки)
+    """
+    # аргументами должны быть только имена файлов, без путей
+    # path дает кривые слеши, поэтому использую конкатенацию строк
+    # убираем расширение файла (у .jpeg и .tiff оно длиннее трех букв)
+    scan_name = labels + '/' + os.path.splitext(images)[0]
+    DST_IMG_FOLDER = './sliced/' + scan_name
+    # папка с готовыми (нарезанными) изображениями
+    SRC_IMG_FOLDER = './data/images'  # папка с исходными (сканированными) изображениями
+    SRC_LBL_FOLDER = './data/labels'  # папка с нарезанными текстами (csv)
+    LABELS_FILE_PATH = SRC_LBL_FOLDER + '/' + labels + '.csv'  # путь к обрабатываемому файлу с ярлыками
+    IMAGE_FILE_PATH = SRC_IMG_FOLDER + '/' + labels + '/' + images  # путь к фотке, которую нарезаем
+
+    prof = profiler or profiling.NULL
+    prof.scan(labels + '/' + images)
+
+    try:
+        with prof.stage('read'), open(IMAGE_FILE_PATH, 'rb') as file:
+            image_bytes = file.read()
+    except OSError:
+        raise Exception("Не удалось прочитать исходный файл")
+
+    cached = None
+    up_to_date = False
+    if cache:
+        with prof.stage('cache_lookup'):
+            slice_cache = sc.open_cache(cache)
+            key = slice_cache.key(image_bytes, dict(pipeline.SLICE_PARAMS, backend=backend, levels=levels,
+                                                    templates=bool(templates)))
+            manifest = slice_cache.read_manifest(DST_IMG_FOLDER)
+            # все файлы уже записаны из этого же скана с теми же настройками - резать нечего
+            up_to_date = bool(manifest['files']) and all(
+                slice_cache.is_current(manifest, DST_IMG_FOLDER, name, key, pipeline.ENHANCE_SETTINGS)
+                for name in manifest['files']) and os.path.exists(DST_IMG_FOLDER + '/' + cell_grid.LAYOUT_FILE)
+            if not up_to_date:
+                cached = slice_cache.load(key)
+
+    if up_to_date:
+        # формирование и запись csv разметки по уже записанным файлам
+        with prof.stage('write_markup'):
+            markup.write_markup(LABELS_FILE_PATH, DST_IMG_FOLDER, labels, page, gender)
+            if export:
+                markup.export_markup(labels)
+        return len(manifest['files']), []
+
+    is_current = None
+    if cache:
+        def is_current(folder, name):
+            return slice_cache.is_current(manifest, folder, name, key, pipeline.ENHANCE_SETTINGS)
+
+    # нарезка, обработка и сопоставление с текстами в памяти, затем запись ячеек
+    # и csv разметки (формат "текст" - "путь к картинке")
+    # мозаика из рукописных ячеек для контроля пишется рядом с папкой скана
+    markup_sink = pipeline.MarkupCsvSink()
+    sinks = [pipeline.JpegFolderSink('./sliced', is_current), markup_sink]
+    scan = pipeline.process_scan(image_bytes, LABELS_FILE_PATH, page, gender, sinks, scan_name,
+                                 backend, levels, templates, sliced=cached, control=DST_IMG_FOLDER + '_control.png',
+                                 nocheck=nocheck, profiler=prof)
+    if export:
+        with prof.stage('write_markup'):
+            markup_sink.close()
+
+    if cache:
+        if cached is None:
+            with prof.stage('cache_store'):
+                slice_cache.store(key, scan['cells'], scan['bitnot'])
+        for record in scan['records']:
+            slice_cache.mark(manifest, os.path.basename(record['path']), key, pipeline.ENHANCE_SETTINGS)
+        slice_cache.write_manifest(DST_IMG_FOLDER, manifest)
+    return len(scan['records']), scan['issues']
+
+
+def add_slice_args(parser):
+    """
+    Параметры нарезки, общие для main.py, batch.py и watch.py
+    :param parser: argparse.ArgumentParser
+    """
+    parser.add_argument("--backend", choices=['legacy', 'grid'], default='legacy',
+                        help="Способ разбора сетки ячеек: legacy - исходный, grid - векторный")
+    parser.add_argument("--levels", type=int, default=0,
+                        help="Искать линии таблицы на копии, уменьшенной в 2^levels раз "
+                             "(проверено: 300 dpi - 1-2, 600 dpi - 1; неполная сетка ищется заново "
+                             "в полном разрешении)")
+    parser.add_argument("--templates", nargs='?', const='./templates', default=None,
+                        help="Использовать реестр бланков (по умолчанию папка ./templates)")
+    parser.add_argument("--cache", nargs='?', const='./cache', default=None,
+                        help="Использовать кэш нарезки (по умолчанию папка ./cache)")
+
+
+def slice_options(args):
+    """
+    :param args: разобранные аргументы парсера с add_slice_args
+    :return: параметры нарезки для slice_scan (backend, levels, templates, cache)
+    """
+    return {'backend': args.backend, 'levels': args.levels, 'templates': args.templates, 'cache': args.cache}
+
 
 if __name__ == '__main__':
     # интерпретатор должен быть запущен в корневой папке проекта!
+    # для пакетной обработки множества сканов см. batch.py
 
     parser = argparse.ArgumentParser()
-    parser.add_argument("labels", choices=['blvrd', 'discipl', 'econ', 'journ', 'koms', 'mathstat'],
+    parser.add_argument("labels", choices=SOURCES,
                         help='Название файла с текстом. Не указывать расширение!')
     parser.add_argument("images", help='Файл с отсканированным изображением')
     parser.add_argument("page", type=int, help='Номер страницы')
     parser.add_argument("gender", type=int, choices=[0,1], help="Пол: 1 - М, 0 - Ж")
     parser.add_argument("--nocheck", action="store_true", help="Не запрашивать подтверждение записи")
+    add_slice_args(parser)
+    parser.add_argument("--profile", nargs='?', const='profile.json', default=None,
+                        help="Замерить время и память по этапам, отчет в json или csv (по умолчанию profile.json)")
     args = parser.parse_args()
 
-    # аргументами должны быть только имена файлов, без путей
-    # path дает кривые слеши, поэтому использую конкатенацию строк
-    DST_IMG_FOLDER = './sliced/' + args.labels + '/' + args.images[:-4]  # убираем расширение файла
-    # папка с готовыми (нарезанными) изображениями
-    SRC_IMG_FOLDER = './data/images'  # папка с исходными (сканированными) изображениями
-    SRC_LBL_FOLDER = './data/labels'  # папка с нарезанными текстами (csv)
-    LABELS_FILE_PATH = SRC_LBL_FOLDER + '/' + args.labels + '.csv'  # путь к обрабатываемому файлу с ярлыками
-    IMAGE_FILE_PATH = SRC_IMG_FOLDER + '/' + args.labels + '/' + args.images  # путь к фотке, которую нарезаем
-
-    img = cv2.imread(IMAGE_FILE_PATH, 0)  # 0 для игнора цветовой палитры (читает ЧБ)
-    if img is None:
-        raise Exception("Не удалось прочитать исходный файл")  # т.к. opencv не выдает ошибок чтения
-
-    # обработка изображений состоит из бинаризации
-    # получения границ таблицы и непосредственно нарезки
-    img_bin = ts.binarize(img)
-    img_vh, bitnot = ts.get_lines(img, img_bin)
-    cropped_images = ts.get_images(img_vh, bitnot, img_bin, w_min=10, h_min=25, h_max=5, debug=False)
-
-    if not os.path.exists(DST_IMG_FOLDER):  # для каждой фотки - своя папка с нарезанными кусочками
-        os.makedirs(DST_IMG_FOLDER)  # папка называется именем файла исходной фотки
-
-    for num, cropped_img in enumerate(cropped_images):
-        enhanced_img = markup.increase_contrast(cropped_img)
-        filename = DST_IMG_FOLDER + '/' + str(num).zfill(3) + '.jpg'  # zfill делает названия 001, 002 и т.п.
-        did_write = cv2.imwrite(filename, enhanced_img)
-        # если не удалось записать файл, самостоятельно вызываем исключение
-        if not did_write:
-            raise Exception("Не удалось сохранить готовый файл")
-
-    # получить из csv тексты с соответствующей страницы
-    answers = markup.read_source(LABELS_FILE_PATH, args.page)
-
-    # контроль
-    ts.control(answers, cropped_images, args.nocheck)
-
-    # формирование и запись csv разметки (формат "текст" - "путь к картинке")
-    markup.write_markup(LABELS_FILE_PATH, DST_IMG_FOLDER, args.labels, args.page, args.gender)
+    profiler = profiling.Profiler() if args.profile else None
+    n_cells, issues = slice_scan(args.labels, args.images, args.page, args.gender, args.nocheck,
+                                 profiler=profiler, **slice_options(args))
+    for issue in issues if args.nocheck else []:
+        print("Замечание: %s" % issue)
     print("Файл разметки сформирован")
+    if profiler:
+        profiler.write(args.profile)
+        profiler.print_summary()
@@ -1,67 +1,227 @@
 import re
+import io
 import csv
 import os
+import json
 import argparse
-import cv2
 import numpy as np
 
+import cell_grid
+import enhance
+import markup_store
 
-def write_source(input_path, line_cnt, words_per_line=3):
+ROWS_PER_PAGE = 20  # на каждой странице у нас по 20 словосочетаний
+
+_page_indexes = {}
+
+
+def _clean_text(text):
+    text = text.lower()
+    text = text.replace('ниу', ' ')
+    text = text.replace('вшэ', ' ')
+    return re.sub(r'[^а-я ]+', ' ', text)
+
+
+def _word_chunks(input_path, words_per_line, chunk_size):
+    """
+    Потоковое чтение текста по блокам слов (весь файл в память не загружается)
+    Соседние блоки перекрываются на words_per_line - 1 слов, так что каждое
+    словосочетание начинается ровно в одном блоке
+    :param input_path: путь к txt файлу источника
+    :param words_per_line: количество слов в строке
+    :param chunk_size: размер читаемого за раз куска текста (в символах)
+    :return: генератор списков слов
+    """
+    tail = []
+    rest = ''
+    with open(input_path, encoding='utf-8') as file:
+        while True:
+            block = file.read(chunk_size)
+            eof = not block
+            block = rest + block
+            rest = ''
+            if not eof:
+                # режем по последнему пробельному символу, чтобы не разорвать слово
+                cut = len(block)
+                while cut > 0 and not block[cut - 1].isspace():
+                    cut -= 1
+                block, rest = block[:cut], block[cut:]
+            words = tail + _clean_text(block).split()
+            yield words
+            if eof:
+                break
+            tail = words[len(words) - words_per_line + 1:] if words_per_line > 1 else []
+
+
+def _valid_starts(words, words_per_line, max_len):
+    """
+    Векторная маска допустимых начал словосочетаний в блоке слов:
+    не больше одного короткого (меньше 3 букв) слова и не длиннее max_len символов
+    :return: маска длины len(words) - words_per_line + 1
+    """
+    n = len(words) - words_per_line + 1
+    if n <= 0:
+        return np.zeros(0, dtype=bool)
+    lengths = np.fromiter(map(len, words), dtype=np.int64, count=len(words))
+    short = np.zeros(len(words) + 1, dtype=np.int64)
+    np.cumsum(lengths < 3, out=short[1:])
+    total = np.zeros(len(words) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=total[1:])
+    window_short = short[words_per_line:] - short[:n]
+    window_len = total[words_per_line:] - total[:n] + words_per_line - 1
+    return (window_short < 2) & (window_len <= max_len)
+
+
+def write_source(input_path, line_cnt, words_per_line=3, seed=None, unique=False, max_len=20,
+                 chunk_size=1 << 20):
     """
     Формирует csv файл из простого текстового файла (файл-источник)
     Данный файл необходим для формирования labels разметки
+    Текст читается потоково в два прохода: сначала считается число допустимых словосочетаний,
+    затем выбранные случайно словосочетания извлекаются без повторных попыток
     :param input_path: путь к txt файлу источника
     :param line_cnt: ограничение на число выходных строк
     :param words_per_line: количество слов в строке
-    :return: None
+    :param seed: зерно генератора случайных чисел (для воспроизводимых файлов labels)
+    :param unique: не повторять одинаковые словосочетания (строк может получиться меньше line_cnt,
+                   если в тексте столько разных словосочетаний нет)
+    :param max_len: максимальная длина словосочетания в символах
+    :param chunk_size: размер читаемого за раз куска текста (в символах)
+    :return: генератор словосочетаний
     """
-    with open(input_path, encoding='utf-8') as file:
-        text = file.read().lower()
-        text = text.replace('ниу', ' ')
-        text = text.replace('вшэ', ' ')
-        text = re.sub(r'[^а-я ]+', ' ', text)
+    counts = [int(_valid_starts(words, words_per_line, max_len).sum())
+              for words in _word_chunks(input_path, words_per_line, chunk_size)]
+    valid_total = sum(counts)
+    if valid_total == 0:
+        raise Exception("В тексте нет подходящих словосочетаний")
+
+    rng = np.random.default_rng(seed)
+    drawn = np.empty(0, dtype=np.int64)
+    seen = set()
+    while line_cnt > 0 and len(drawn) < valid_total:
+        if unique:
+            # без возвращения (в том числе относительно прошлых раундов)
+            # и с запасом на словосочетания, совпавшие по тексту
+            size = min(valid_total - len(drawn), line_cnt + line_cnt // 4 + 1)
+            picks = rng.choice(valid_total - len(drawn), size=size, replace=False)
+            # номер среди еще не выбранных -> номер среди всех
+            picks += np.searchsorted(drawn - np.arange(len(drawn)), picks, side='right')
+            drawn = np.sort(np.concatenate((drawn, picks)))
+        else:
+            picks = rng.integers(0, valid_total, size=line_cnt)
+
+        # второй проход: достаем выбранные словосочетания по их порядковым номерам
+        phrases = {}
+        wanted = np.unique(picks)
+        base = 0
+        for count, words in zip(counts, _word_chunks(input_path, words_per_line, chunk_size)):
+            lo, hi = np.searchsorted(wanted, [base, base + count])
+            if hi > lo:
+                starts = np.flatnonzero(_valid_starts(words, words_per_line, max_len))
+                for pick in wanted[lo:hi]:
+                    start = starts[pick - base]
+                    phrases[int(pick)] = ' '.join(words[start: start + words_per_line])
+            base += count
+
+        for pick in picks:
+            concat = phrases[int(pick)]
+            if unique:
+                if concat in seen:
+                    continue
+                seen.add(concat)
+            line_cnt -= 1
+            yield concat
+            if line_cnt == 0:
+                break
+
+
+def page_index(path):
+    """
+    Индекс страниц csv-файла с labels: смещения в байтах начала каждой страницы
+    Индекс хранится рядом с файлом (<path>.idx) и перестраивается при изменении файла
+    :param path: путь к файлу
+    :return: список смещений (i-й элемент - начало страницы i + 1)
+    """
+    stat = os.stat(path)
+    stamp = [stat.st_mtime_ns, stat.st_size]
+    cached = _page_indexes.get(path)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
 
-    words = text.split()
-    words_total = len(words) - 3
+    index_path = path + '.idx'
+    offsets = None
+    try:
+        with open(index_path, encoding='utf-8') as file:
+            index = json.load(file)
+        if index['stamp'] == stamp and index['rows_per_page'] == ROWS_PER_PAGE:
+            offsets = index['offsets']
+    except (OSError, ValueError, KeyError):
+        pass
 
-    while line_cnt > 0:
-        rand = np.random.randint(0, words_total)
-        if len(words[rand]) < 3 and len(words[rand + 1]) < 3:
-            continue
-        elif len(words[rand + 1]) < 3 and len(words[rand + 2]) < 3:
-            continue
-        elif len(words[rand]) < 3 and len(words[rand + 2]) < 3:
-            continue
+    if offsets is None:
+        offsets = []
+        position = 0
+        with open(path, 'rb') as file:
+            for n, line in enumerate(file):
+                if n % ROWS_PER_PAGE == 0:
+                    offsets.append(position)
+                position += len(line)
+        # индекс пишется через временный файл - его могут одновременно строить несколько процессов
+        tmp_path = index_path + '.%d.tmp' % os.getpid()
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as file:
+                json.dump({'stamp': stamp, 'rows_per_page': ROWS_PER_PAGE, 'offsets': offsets}, file)
+            os.replace(tmp_path, index_path)
+        except OSError:
+            pass  # без сохраненного индекса просто построим его заново в следующий раз
 
-        concat = ' '.join(words[rand: rand + words_per_line])
-        if len(concat) > 20:
-            continue
+    _page_indexes[path] = (stamp, offsets)
+    return offsets
 
-        line_cnt -= 1
-        yield concat
+
+def _read_page(file, offsets, page):
+    if not 0 < page <= len(offsets):
+        return []
+    file.seek(offsets[page - 1])
+    answers = []
+    # TextIOWrapper читает с текущей позиции файла, кодировка - как у open() по умолчанию
+    text = io.TextIOWrapper(file, newline='')
+    try:
+        for row in csv.reader(text):
+            answers.append(row[0])  # у нашего файла 1 столбец
+            if len(answers) >= ROWS_PER_PAGE:
+                break
+    finally:
+        text.detach()  # не закрываем файл вместе с оберткой
+    return answers
 
 
 def read_source(path, page):
     """
     Вспомогательная функция для чтения сформированного csv-файла (labels будущей разметки)
-    :param nrows: сколько строк считывать
-    :param offset: смещение (пропуск N строк)
+    Страница читается по индексу смещений, без пропуска предыдущих строк
     :param path: путь к файлу
+    :param page: номер страницы (на каждой странице по 20 словосочетаний)
     :return: список из словосочетаний
     """
-    nrows = 20
-    offset = (page - 1) * nrows  # на каждой странице у нас по 20 словосочетаний
-    n = 0
-    with open(path, newline='') as file:
-        answers = []
-        for _ in range(offset):  # skip first 10 rows
-            next(file)
-        for row in csv.reader(file):
-            answers.append(row[0])  # у нашего файла 1 столбец
-            n += 1
-            if n >= nrows:
-                break
-    return answers
+    offsets = page_index(path)
+    with open(path, 'rb') as file:
+        return _read_page(file, offsets, page)
+
+
+def read_pages(path, pages):
+    """
+    Чтение сразу нескольких страниц csv-файла с labels (для пакетной нарезки)
+    :param path: путь к файлу
+    :param pages: номера страниц
+    :return: словарь {номер страницы: список из словосочетаний}
+    """
+    offsets = page_index(path)
+    result = {}
+    with open(path, 'rb') as file:
+        for page in sorted(set(pages)):  # по возрастанию смещений - чтение идет вперед по файлу
+            result[page] = _read_page(file, offsets, page)
+    return result
 
 
 def write_markup(labels_path, image_folder, labels_filename, page, gender):
@@ -75,45 +235,50 @@ def write_markup(labels_path, image_folder, labels_filename, page, gender):
     :param image_folder: путь к папке с нарезанными изображениями
     :return:
     """
-    markup_file_path = './markup/markup_' + labels_filename + '.csv'
-
     labels = read_source(labels_path, page)
-    image_list = os.listdir(image_folder)
-    # половина ячеек таблицы - печатный текст (исходник)
-    # такие ячейки пропускаем, берем только нечетные
-    images = [image_folder + '/' + file for idx, file in enumerate(image_list) if idx % 2 == 1]
+    # печатные ячейки не записываются, порядок рукописных берется из описания ячеек скана
+    images = [image_folder + '/' + file for file in cell_grid.handwritten_files(image_folder)]
 
     assert labels, "Список текстов пустой"
     assert images, "Директория с нарезанными картинками пуста"
     assert len(labels) == len(images), "Несовпадение длин массивов картинок и текстов"
 
-    # если файла не существует (пишем в него первый раз) - добавляем заголовок
-    if not os.path.exists(markup_file_path):
-        with open(markup_file_path, "w", newline='') as file:
-            writer = csv.writer(file)
-            writer.writerow(('label', 'image', 'gender'))
+    append_markup(labels_filename, page, [(label, image, gender) for label, image in zip(labels, images)])
 
-    # после этого добавляем в файл обработанные строки
-    with open(markup_file_path, "a", newline='') as file:
-        writer = csv.writer(file)
-        for pair in zip(labels, images):
-            row = (pair[0], pair[1], gender)
-            writer.writerow(row)
+
+def append_markup(labels_filename, page, rows):
+    """
+    Добавляет строки разметки в хранилище (markup_store, одной транзакцией;
+    строки с тем же путем к картинке заменяются). csv обновляется через export_markup
+    :param labels_filename: называние файла с текстами строк
+    :param page: номер страницы
+    :param rows: строки (текст, путь к картинке, пол)
+    """
+    store = markup_store.open_store()
+    markup_file_path = './markup/markup_' + labels_filename + '.csv'
+    # разметка, записанная до появления хранилища, загружается в него первой
+    if os.path.exists(markup_file_path) and not store.count(labels_filename):
+        store.import_csv(labels_filename, markup_file_path)
+    store.add(labels_filename, page, rows)
+
+
+def export_markup(labels_filename):
+    """
+    Перезаписывает markup/markup_<labels_filename>.csv из хранилища (формат: label, image, gender)
+    :param labels_filename: называние файла с текстами строк
+    :return: количество строк
+    """
+    return markup_store.open_store().export_csv(labels_filename, './markup/markup_' + labels_filename + '.csv')
 
 
 def increase_contrast(img):
     """
     Увеличивает контрастность и толщину линий для улучшения качества распознавания
+    (обертка над enhance.increase_contrast, результат - uint8)
     :param img: исходное изображение
     :return: обработанное изображение
     """
-    pxmin = np.min(img)
-    pxmax = np.max(img)
-    imgContrast = (img - pxmin) / (pxmax - pxmin) * 255
-
-    kernel = np.ones((3, 3), np.uint8)
-    imgMorph = cv2.erode(imgContrast, kernel, iterations=1)
-    return imgMorph
+    return enhance.increase_contrast(img)
 
 
 if __name__ == '__main__':
@@ -123,7 +288,9 @@ if __name__ == '__main__':
     parser.add_argument("source", choices=['blvrd', 'discipl', 'econ', 'journ', 'koms', 'mathstat'],
                         help='Название файла с текстом. Не указывать расширение!')
     parser.add_argument("-p", "--pages", default=200, type=int, help="Кол-во страниц")
-    parser.add_argument("r", "--rewrite", action="store_true", help="Флаг перезаписи файлов")
+    parser.add_argument("-r", "--rewrite", action="store_true", help="Флаг перезаписи файлов")
+    parser.add_argument("--seed", type=int, default=None, help="Зерно генератора (воспроизводимый файл)")
+    parser.add_argument("--unique", action="store_true", help="Не повторять одинаковые словосочетания")
     args = parser.parse_args()
 
     line_cnt = args.pages * 20  # 20 строк на странице
@@ -137,5 +304,5 @@ if __name__ == '__main__':
 
     with open(LABELS_FILE_PATH, "w", newline='') as f:
         writer = csv.writer(f)
-        for pair in write_source(TXT_FILE_PATH, line_cnt=line_cnt):
+        for pair in write_source(TXT_FILE_PATH, line_cnt=line_cnt, seed=args.seed, unique=args.unique):
             writer.writerow([pair])
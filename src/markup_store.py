@@ -0,0 +1,161 @@
+import os
+import csv
+import sqlite3
+import argparse
+
+_stores = {}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS markup (
+    image TEXT PRIMARY KEY,
+    label TEXT NOT NULL,
+    source TEXT NOT NULL,
+    page INTEGER,
+    gender INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS markup_source_page ON markup (source, page);
+CREATE INDEX IF NOT EXISTS markup_source_gender ON markup (source, gender);
+CREATE INDEX IF NOT EXISTS markup_gender ON markup (gender);
+"""
+
+
+class MarkupStore:
+    """
+    Хранилище разметки в SQLite (режим WAL): несколько процессов могут писать одновременно,
+    строки одного скана добавляются одной транзакцией, а повторная нарезка скана
+    заменяет его строки (ключ - путь к картинке), а не дублирует их
+    """
+
+    def __init__(self, path='./markup/markup.db', timeout=60.0):
+        """
+        :param path: файл базы
+        :param timeout: сколько ждать освобождения базы другим процессом, в секундах
+        """
+        self.path = path
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder, exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=timeout)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        # в режиме WAL этого достаточно для целостности базы, fsync только на контрольных точках
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        with self.conn:
+            self.conn.executescript(_SCHEMA)
+
+    def add(self, source, page, rows):
+        """
+        Добавляет строки разметки одной транзакцией
+        :param source: название файла с текстами
+        :param page: номер страницы (None - неизвестен)
+        :param rows: строки (текст, путь к картинке, пол)
+        :return: количество строк
+        """
+        rows = [(image, label, source, page, int(gender)) for label, image, gender in rows]
+        with self.conn:
+            self.conn.executemany(
+                'INSERT INTO markup (image, label, source, page, gender) VALUES (?, ?, ?, ?, ?) '
+                'ON CONFLICT (image) DO UPDATE SET label = excluded.label, source = excluded.source, '
+                'page = excluded.page, gender = excluded.gender', rows)
+        return len(rows)
+
+    @staticmethod
+    def _where(source, page, gender):
+        conditions, params = [], []
+        for column, value in (('source', source), ('page', page), ('gender', gender)):
+            if value is not None:
+                conditions.append(column + ' = ?')
+                params.append(value)
+        return (' WHERE ' + ' AND '.join(conditions) if conditions else ''), params
+
+    def count(self, source=None, page=None, gender=None):
+        """
+        Количество образцов, например count('econ', gender=0) - женских образцов econ
+        """
+        where, params = self._where(source, page, gender)
+        return self.conn.execute('SELECT COUNT(*) FROM markup' + where, params).fetchone()[0]
+
+    def rows(self, source=None, page=None, gender=None):
+        """
+        :return: строки (текст, путь к картинке, пол) по страницам
+        """
+        where, params = self._where(source, page, gender)
+        return self.conn.execute('SELECT label, image, gender FROM markup' + where + ' ORDER BY page, image',
+                                 params).fetchall()
+
+    def sources(self):
+        return [row[0] for row in self.conn.execute('SELECT DISTINCT source FROM markup ORDER BY source')]
+
+    def import_csv(self, source, path):
+        """
+        Загружает разметку из csv прежнего формата (label, image, gender), номер страницы неизвестен
+        :return: количество строк
+        """
+        with open(path, newline='') as file:
+            rows = [(row['label'], row['image'], row['gender']) for row in csv.DictReader(file)]
+        return self.add(source, None, rows)
+
+    def export_csv(self, source, path):
+        """
+        Выгружает разметку источника в csv прежнего формата (label, image, gender)
+        Файл заменяется целиком, читатели никогда не видят его недописанным
+        :return: количество строк
+        """
+        rows = self.rows(source)
+        tmp_path = path + '.%d.tmp' % os.getpid()
+        with open(tmp_path, 'w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(('label', 'image', 'gender'))
+            writer.writerows(rows)
+        os.replace(tmp_path, path)
+        return len(rows)
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_store(path='./markup/markup.db'):
+    """
+    Хранилище разметки, общее для всех вызовов внутри процесса
+    (соединение sqlite нельзя передавать в дочерний процесс, поэтому у каждого процесса - свое)
+    :param path: файл базы
+    :return: MarkupStore
+    """
+    key = (path, os.getpid())
+    if key not in _stores:
+        _stores[key] = MarkupStore(path)
+    return _stores[key]
+
+
+if __name__ == '__main__':
+    # интерпретатор должен быть запущен в корневой папке проекта!
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db", default='./markup/markup.db', help='Файл базы разметки')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    load = subparsers.add_parser('import', help='Загрузить разметку из csv (markup/markup_<источник>.csv)')
+    load.add_argument('markup', nargs='+', help='csv-файлы разметки')
+    export = subparsers.add_parser('export', help='Выгрузить разметку в markup/markup_<источник>.csv')
+    export.add_argument('sources', nargs='*', help='Источники (по умолчанию все)')
+    count = subparsers.add_parser('count', help='Количество образцов по источникам и полу')
+    count.add_argument('--source', help='Только этот источник')
+    args = parser.parse_args()
+
+    with MarkupStore(args.db) as store:
+        if args.command == 'import':
+            for path in args.markup:
+                # имя источника берется из имени файла markup_<источник>.csv
+                source = os.path.splitext(os.path.basename(path))[0][len('markup_'):]
+                print("%s: загружено строк %d" % (source, store.import_csv(source, path)))
+        elif args.command == 'export':
+            for source in args.sources or store.sources():
+                n = store.export_csv(source, './markup/markup_' + source + '.csv')
+                print("%s: выгружено строк %d" % (source, n))
+        else:
+            for source in [args.source] if args.source else store.sources():
+                print("%-10s всего %6d, М %6d, Ж %6d" % (source, store.count(source), store.count(source, gender=1),
+                                                         store.count(source, gender=0)))
@@ -0,0 +1,301 @@
+import os
+
+import cv2
+import numpy as np
+
+import cell_grid
+import enhance
+import markup
+import profiling
+import shards
+import table_slice as ts
+import templates as tpl
+
+# параметры нарезки, от которых зависят найденные ячейки (входят в ключ кэша)
+SLICE_PARAMS = {'w_min': 10, 'h_min': 25, 'h_max': 5, 'line_kernel': 'width // 200',
+                'vh_kernel': (2, 2), 'cell_kernel': (2, 1), 'cell_scale': 2,
+                'cell_interpolation': 'cubic', 'printed_cols': (0,), 'form_grid': (20, 2)}
+# настройки обработки нарезанных ячеек перед записью (при их изменении файлы перезаписываются)
+ENHANCE_SETTINGS = {'func': 'increase_contrast', 'kernel': (3, 3)}
+
+
+def find_cells(img, backend='legacy', levels=0, templates=None, prof=profiling.NULL):
+    """
+    Поиск ячеек таблицы на скане
+    :param img: скан (ndarray uint8, оттенки серого)
+    :param backend: способ разбора сетки ячеек ('legacy' или 'grid')
+    :param levels: число уровней пирамиды при поиске линий таблицы. Если в уменьшенной копии
+                   сетка бланка (SLICE_PARAMS['form_grid']) найдена не целиком, линии ищутся заново
+                   в полном разрешении
+    :param templates: папка реестра бланков (None - не использовать)
+    :param prof: profiling.Profiler для замера этапов
+    :return: (массив ячеек (N, 6) из row, col, x, y, w, h, изображение без линий таблицы)
+    """
+    # обработка изображений состоит из бинаризации
+    # получения границ таблицы и непосредственно нарезки
+    with prof.stage('binarize'):
+        img_bin = ts.binarize(img)
+    with prof.stage('get_lines'):
+        img_vh, bitnot = ts.get_lines(img, img_bin, levels)
+    cells = None
+    if templates:
+        with prof.stage('template_match'):
+            registry = tpl.open_registry(templates)
+            cells, support = registry.match(img_vh)
+    if cells is None:
+        with prof.stage('contours') as stage:
+            cells = _pyramid_cells(img_vh, img_bin, backend) if levels > 0 else ts.get_cells(img_vh, img_bin, backend)
+            stage.cells = 0 if cells is None else len(cells)
+        if cells is None:
+            # в уменьшенной копии штрихи печатного текста могут сойти за линии, а тонкие линии - пропасть
+            with prof.stage('get_lines_full'):
+                img_vh, bitnot = ts.get_lines(img, img_bin)
+            with prof.stage('contours') as stage:
+                cells = ts.get_cells(img_vh, img_bin, backend)
+                stage.cells = len(cells)
+        if templates:
+            registry.add(img_vh, cells)
+    return cells, bitnot
+
+
+def _pyramid_cells(img_vh, img_bin, backend):
+    """
+    Ячейки по линиям, найденным в уменьшенной копии
+    :return: массив ячеек или None, если сетка бланка найдена не целиком
+    """
+    try:
+        cells = ts.get_cells(img_vh, img_bin, backend)
+    except ValueError:  # legacy-разбор падает на строках с разным числом ячеек
+        return None
+    # строки и столбцы legacy-разбора зависят от порядка контуров (например, все ячейки
+    # могут попасть в одну строку), поэтому полнота проверяется по сетке из самих прямоугольников
+    grid = cell_grid.build_grid(cells[:, 2:])
+    return cells if cell_grid.is_complete(grid, SLICE_PARAMS['form_grid']) else None
+
+
+def crop_handwritten(cells, bitnot, prof=profiling.NULL):
+    """
+    Вырезает и подготавливает только рукописные ячейки
+    :param cells: массив ячеек (N, 6) из row, col, x, y, w, h
+    :param bitnot: изображение без линий таблицы (как возвращает find_cells)
+    :param prof: profiling.Profiler для замера этапов
+    :return: список рукописных сегментов изображения
+    """
+    roles = cell_grid.cell_roles(cells, SLICE_PARAMS['printed_cols'])
+    with prof.stage('crop_cells') as stage:
+        cropped_images = ts.crop_cells(bitnot, cells[roles == cell_grid.HANDWRITTEN], SLICE_PARAMS['cell_scale'],
+                                       SLICE_PARAMS['cell_interpolation'])
+        stage.cells = len(cropped_images)
+    return cropped_images
+
+
+def process_scan(image, labels_source, page, gender, sinks=(), name=None, backend='legacy', levels=0,
+                 templates=None, sliced=None, control=None, nocheck=True, profiler=None):
+    """
+    Обработка скана целиком в памяти: бинаризация, линии, ячейки, обработка рукописных ячеек
+    и сопоставление их с текстами. Кодирование и запись выполняют приемники (sinks), поэтому
+    одно декодирование скана обслуживает все форматы вывода
+    :param image: скан: ndarray uint8 (оттенки серого), байты файла или путь к файлу
+    :param labels_source: путь к csv-файлу с текстами или список текстов страницы
+    :param page: номер страницы
+    :param gender: пол заполнившего лист
+    :param sinks: приемники результата (JpegFolderSink, MarkupCsvSink, IamSink, ShardSink),
+                  вызываются по порядку: приемникам разметки нужны пути, записанные JpegFolderSink
+    :param name: имя скана вида <источник>/<файл без расширения>, по нему строятся пути
+    :param backend: способ разбора сетки ячеек ('legacy' или 'grid')
+    :param levels: число уровней пирамиды при поиске линий таблицы
+    :param templates: папка реестра бланков (None - не использовать)
+    :param sliced: уже найденные (ячейки, изображение без линий таблицы), например из кэша -
+                   поиск линий и ячеек не выполняется
+    :param control: куда записать контрольную мозаику (None - только автоматическая проверка)
+    :param nocheck: не запрашивать подтверждение (см. table_slice.control)
+    :param profiler: profiling.Profiler для замера этапов обработки
+    :return: словарь скана: name, source, page, gender, labels, cells (N, 6), roles, bitnot, crops (рукописные
+             сегменты до обработки), records (по записи на рукописную ячейку: cell, row, col, bbox,
+             label, image, gender, path) и issues (замечания автоматической проверки)
+    """
+    prof = profiler or profiling.NULL
+    if isinstance(labels_source, str):
+        with prof.stage('read_source'):
+            labels = markup.read_source(labels_source, page)
+        source = os.path.splitext(os.path.basename(labels_source))[0]
+    else:
+        labels, source = list(labels_source), None
+    if source is None and name is not None:
+        source = name.split('/')[0]
+
+    if sliced is None:
+        if isinstance(image, str):
+            with prof.stage('read'), open(image, 'rb') as file:
+                image = file.read()
+        if isinstance(image, (bytes, bytearray, memoryview)):
+            with prof.stage('decode'):
+                # 0 для игнора цветовой палитры (читает ЧБ)
+                image = cv2.imdecode(np.frombuffer(image, np.uint8), cv2.IMREAD_GRAYSCALE)
+        if image is None:
+            raise Exception("Не удалось прочитать исходный файл")  # т.к. opencv не выдает ошибок чтения
+        cells, bitnot = find_cells(image, backend, levels, templates, prof)
+    else:
+        cells, bitnot = sliced
+    crops = crop_handwritten(cells, bitnot, prof)
+    roles = cell_grid.cell_roles(cells, SLICE_PARAMS['printed_cols'])
+
+    records = []
+    enhancer = enhance.Enhancer()  # буферы обработки общие для всех ячеек скана
+    for i, (num, crop) in enumerate(zip(np.flatnonzero(roles == cell_grid.HANDWRITTEN), crops)):
+        with prof.stage('increase_contrast') as stage:
+            enhanced_img = enhancer(crop).copy()
+            stage.cells = 1
+        row, col, x, y, w, h = (int(v) for v in cells[num])
+        records.append({'cell': int(num), 'row': row, 'col': col, 'bbox': [x, y, w, h],
+                        'label': labels[i] if i < len(labels) else None, 'image': enhanced_img,
+                        'gender': gender, 'path': None})
+
+    with prof.stage('control'):
+        if control is None:
+            issues = ts.inspect_cells(crops, expected=len(labels))
+        else:
+            if os.path.dirname(control) and not os.path.exists(os.path.dirname(control)):
+                os.makedirs(os.path.dirname(control))
+            issues = ts.control(labels, crops, nocheck, control)
+
+    scan = {'name': name, 'source': source, 'page': page, 'gender': gender, 'labels': labels, 'cells': cells,
+            'roles': roles, 'bitnot': bitnot, 'crops': crops, 'records': records, 'issues': issues}
+    for sink in sinks:
+        sink.write(scan, prof)
+    return scan
+
+
+def _labelled(scan):
+    # приемникам разметки нужен текст для каждой рукописной ячейки
+    if len(scan['labels']) != len(scan['records']) or not scan['records']:
+        raise Exception("Несовпадение числа ячеек и текстов в скане %s" % scan['name'])
+    return scan['records']
+
+
+class JpegFolderSink:
+    """
+    Запись обработанных ячеек в <root>/<имя скана>/NNN.jpg и описания ячеек (cell_grid.LAYOUT_FILE)
+    Файлы называются по номеру ячейки в таблице, пути записываются в record['path']
+    """
+
+    def __init__(self, root='./sliced', is_current=None):
+        """
+        :param root: корневая папка нарезанных изображений
+        :param is_current: функция (папка, имя файла) -> bool: файл уже записан и не требует
+                           перезаписи (используется кэшем нарезки)
+        """
+        self.root = root
+        self.is_current = is_current
+
+    def write(self, scan, prof=profiling.NULL):
+        if scan['name'] is None:
+            raise Exception("Для записи ячеек нужно имя скана")
+        # path дает кривые слеши, поэтому использую конкатенацию строк
+        folder = self.root + '/' + scan['name']
+        if not os.path.exists(folder):  # для каждой фотки - своя папка с нарезанными кусочками
+            os.makedirs(folder)  # папка называется именем файла исходной фотки
+
+        files = [None] * len(scan['cells'])
+        for record in scan['records']:
+            name = str(record['cell']).zfill(3) + '.jpg'  # zfill делает названия 001, 002 и т.п.
+            files[record['cell']] = name
+            record['path'] = folder + '/' + name
+            if self.is_current and self.is_current(folder, name):
+                continue
+            with prof.stage('imwrite'):
+                did_write = cv2.imwrite(record['path'], record['image'])
+            # если не удалось записать файл, самостоятельно вызываем исключение
+            if not did_write:
+                raise Exception("Не удалось сохранить готовый файл")
+        # описание ячеек заменяет разбор содержимого папки в write_markup, DataProvider и cleaner
+        cell_grid.write_layout(folder, scan['cells'], scan['roles'], files)
+
+    def close(self):
+        pass
+
+
+class MarkupCsvSink:
+    """
+    Записывает разметку скана (текст, путь к картинке, пол) в хранилище разметки,
+    а при закрытии выгружает markup/markup_<источник>.csv для затронутых источников
+    Ставится после JpegFolderSink, который заполняет пути
+    """
+
+    def __init__(self):
+        self.sources = set()
+
+    def write(self, scan, prof=profiling.NULL):
+        records = _labelled(scan)
+        if any(record['path'] is None for record in records):
+            raise Exception("Ячейки скана %s не записаны на диск" % scan['name'])
+        with prof.stage('write_markup'):
+            markup.append_markup(scan['source'], scan['page'],
+                                 [(r['label'], r['path'], r['gender']) for r in records])
+        self.sources.add(scan['source'])
+
+    def close(self):
+        for source in sorted(self.sources):
+            markup.export_markup(source)
+        self.sources.clear()
+
+
+class IamSink:
+    """
+    Дописывает ячейки в IAM-совместимый набор (words.txt и sub/sub-sub/, как createIAMdataset)
+    """
+
+    def __init__(self, out_dir='..', compression=3):
+        """
+        :param out_dir: папка набора
+        :param compression: уровень сжатия png (0-9)
+        """
+        self.words_path = os.path.join(out_dir, 'words.txt')
+        self.img_dir = os.path.join(out_dir, 'sub', 'sub-sub')
+        self.compression = compression
+        if not os.path.exists(self.img_dir):
+            os.makedirs(self.img_dir)
+        # продолжаем нумерацию образцов уже существующего набора
+        self.count = 0
+        if os.path.exists(self.words_path):
+            with open(self.words_path) as file:
+                self.count = sum(1 for line in file)
+
+    def write(self, scan, prof=profiling.NULL):
+        records = _labelled(scan)
+        with prof.stage('iam_export'), open(self.words_path, 'a') as file:
+            for record in records:
+                path = os.path.join(self.img_dir, 'sub-sub-%d.png' % self.count)
+                if not cv2.imwrite(path, record['image'], [cv2.IMWRITE_PNG_COMPRESSION, self.compression]):
+                    raise Exception("Не удалось сохранить файл %s" % path)
+                file.write('sub-sub-%d' % self.count + ' X X X X X X X ' + record['label'] + '\n')
+                self.count += 1
+
+    def close(self):
+        pass
+
+
+class ShardSink:
+    """
+    Упаковка ячеек в шарды (shards.ShardWriter) без промежуточных файлов
+    Один приемник передается в process_scan для всех сканов и закрывается после последнего:
+    шард закрывается по достижении shard_bytes или при close(), поэтому приемник на каждый скан
+    дал бы по крошечному шарду на скан. Несколько приемников (например, в процессах пула)
+    могут писать в одну папку одновременно - номера шардов и shards.json общие под блокировкой
+    """
+
+    def __init__(self, folder, shard_bytes=64 * 1024 ** 2):
+        """
+        :param folder: папка для шардов
+        :param shard_bytes: размер блока пикселей одного шарда
+        """
+        self.writer = shards.ShardWriter(folder, shard_bytes)
+
+    def write(self, scan, prof=profiling.NULL):
+        records = _labelled(scan)
+        with prof.stage('shard_write'):
+            for record in records:
+                self.writer.add(record['image'], record['label'], record['gender'], record['path'] or '')
+
+    def close(self):
+        self.writer.close()
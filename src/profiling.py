@@ -0,0 +1,149 @@
+import csv
+import json
+import time
+import tracemalloc
+
+import numpy as np
+
+# поля записи об этапе обработки
+FIELDS = ('scan', 'stage', 'seconds', 'peak_bytes', 'calls', 'cells')
+
+
+class _Stage:
+    __slots__ = ('profiler', 'name', 'cells', 'start', 'mem_start')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.cells = None
+
+    def __enter__(self):
+        if self.profiler.memory:
+            tracemalloc.reset_peak()
+            self.mem_start = tracemalloc.get_traced_memory()[0]
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.start
+        peak = tracemalloc.get_traced_memory()[1] - self.mem_start if self.profiler.memory else 0
+        self.profiler._add(self.name, seconds, peak, self.cells)
+
+
+class _NullStage:
+    # отключенный профилировщик: никаких замеров, один общий объект на все этапы
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def __setattr__(self, name, value):
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+
+class Profiler:
+    """
+    Замер времени, пикового прироста памяти (через tracemalloc) и числа ячеек по этапам обработки
+    Повторные вызовы одного этапа в рамках скана (например, запись каждой ячейки) суммируются
+    """
+
+    def __init__(self, enabled=True, memory=True):
+        """
+        :param enabled: включить замеры (выключенный профилировщик почти ничего не стоит)
+        :param memory: замерять память (tracemalloc заметно замедляет выделение памяти)
+        """
+        self.enabled = enabled
+        self.memory = enabled and memory
+        self.scan_name = None
+        self.records = {}
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def scan(self, name):
+        """
+        Задает скан, к которому относятся следующие замеры
+        :param name: имя скана
+        """
+        self.scan_name = name
+
+    def stage(self, name):
+        """
+        Контекстный менеджер замера этапа. Число ячеек можно записать в атрибут cells
+        :param name: название этапа
+        """
+        if not self.enabled:
+            return _NULL_STAGE
+        return _Stage(self, name)
+
+    def _add(self, name, seconds, peak, cells):
+        key = (self.scan_name, name)
+        record = self.records.get(key)
+        if record is None:
+            self.records[key] = {'scan': self.scan_name, 'stage': name, 'seconds': seconds,
+                                 'peak_bytes': peak, 'calls': 1, 'cells': cells}
+        else:
+            record['seconds'] += seconds
+            record['peak_bytes'] = max(record['peak_bytes'], peak)
+            record['calls'] += 1
+            if cells is not None:
+                record['cells'] = (record['cells'] or 0) + cells
+
+    def extend(self, records):
+        """
+        Добавляет записи, полученные в другом процессе
+        :param records: список записей (как в rows())
+        """
+        for record in records:
+            self.records[(record['scan'], record['stage'])] = dict(record)
+
+    def rows(self):
+        return list(self.records.values())
+
+    def summary(self):
+        """
+        Сводка по этапам для всей пачки сканов
+        :return: {этап: {count, total, mean, p50, p90, p99, peak_bytes}}
+        """
+        stages = {}
+        for record in self.records.values():
+            stages.setdefault(record['stage'], []).append(record)
+        result = {}
+        for name, records in stages.items():
+            seconds = np.array([r['seconds'] for r in records])
+            p50, p90, p99 = np.percentile(seconds, [50, 90, 99])
+            result[name] = {'count': len(records), 'total': float(seconds.sum()),
+                            'mean': float(seconds.mean()), 'p50': float(p50), 'p90': float(p90),
+                            'p99': float(p99), 'peak_bytes': max(r['peak_bytes'] for r in records)}
+        return result
+
+    def write(self, path):
+        """
+        Записывает отчет: .csv - по записи на этап каждого скана, иначе json с записями и сводкой
+        :param path: путь к файлу отчета
+        """
+        if path.endswith('.csv'):
+            with open(path, 'w', newline='') as file:
+                writer = csv.DictWriter(file, FIELDS)
+                writer.writeheader()
+                writer.writerows(self.rows())
+        else:
+            with open(path, 'w', encoding='utf-8') as file:
+                json.dump({'records': self.rows(), 'summary': self.summary()}, file,
+                          ensure_ascii=False, indent=1)
+
+    def print_summary(self):
+        print("%-18s %6s %9s %9s %9s %9s %10s" % ('этап', 'сканов', 'p50, с', 'p90, с', 'p99, с',
+                                                   'всего, с', 'пик, МБ'))
+        for name, s in self.summary().items():
+            print("%-18s %6d %9.4f %9.4f %9.4f %9.2f %10.1f" % (name, s['count'], s['p50'], s['p90'],
+                                                               s['p99'], s['total'], s['peak_bytes'] / 2 ** 20))
+
+
+# профилировщик по умолчанию - выключенный
+NULL = Profiler(enabled=False)
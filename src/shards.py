@@ -0,0 +1,268 @@
+import os
+import re
+import csv
+import json
+import time
+import argparse
+from contextlib import contextmanager
+
+import cv2
+import numpy as np
+
+# запись индекса шарда: где лежит фрагмент в блоке пикселей и что на нем написано
+INDEX_DTYPE = np.dtype([('offset', '<u8'), ('height', '<u4'), ('width', '<u4'), ('gender', 'i1')])
+# список готовых шардов папки: читаются только они, а не все *.bin
+MANIFEST = 'shards.json'
+SHARD_NAME = re.compile(r'^shard_(\d{5})\.bin$')
+# файл блокировки папки: номер нового шарда и MANIFEST меняются только под ней
+LOCK_FILE = 'shards.lock'
+
+
+@contextmanager
+def _folder_lock(folder, timeout=60.0, stale=60.0):
+    """
+    Исключительная блокировка папки шардов между процессами (файл, созданный с O_EXCL)
+    Держится только на время выбора номера и обновления MANIFEST, поэтому блокировка
+    старше stale секунд считается оставленной упавшим процессом и снимается
+    :param folder: папка шардов
+    :param timeout: сколько ждать блокировку, в секундах
+    :param stale: возраст, после которого чужая блокировка снимается, в секундах
+    """
+    path = os.path.join(folder, LOCK_FILE)
+    deadline = time.time() + timeout
+    while True:
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(path) > stale:
+                    os.remove(path)
+                    continue
+            except FileNotFoundError:
+                continue
+            if time.time() > deadline:
+                raise Exception("Папка шардов %s занята другим процессом (%s)" % (folder, path))
+            time.sleep(0.01)
+    try:
+        os.write(fd, str(os.getpid()).encode())
+        yield
+    finally:
+        os.close(fd)
+        os.remove(path)
+
+
+def _existing_shards(folder):
+    """
+    Шарды папки по порядку: из MANIFEST, а для папок, записанных до его появления, - по файлам
+    :return: список имен вида shard_NNNNN
+    """
+    path = os.path.join(folder, MANIFEST)
+    if os.path.exists(path):
+        with open(path, encoding='utf-8') as file:
+            return json.load(file)['shards']
+    # только дописанные шарды: labels.json пишется последним
+    files = set(os.listdir(folder))
+    return sorted(f[:-len('.bin')] for f in files if SHARD_NAME.match(f) and f[:-len('.bin')] + '.labels.json' in files)
+
+
+def _write_manifest(folder, names):
+    # запись через временный файл: читатель видит либо старый список, либо новый
+    path = os.path.join(folder, MANIFEST)
+    tmp_path = path + '.%d.tmp' % os.getpid()
+    with open(tmp_path, 'w', encoding='utf-8') as file:
+        json.dump({'shards': names}, file, indent=1)
+    os.replace(tmp_path, path)
+
+
+class ShardWriter:
+    """
+    Упаковка фрагментов в шарды фиксированного размера:
+    shard_NNNNN.bin - подряд записанные пиксели uint8,
+    shard_NNNNN.idx.npy - смещение, размеры и пол для каждого фрагмента,
+    shard_NNNNN.labels.json - тексты и исходные пути фрагментов,
+    shards.json - список готовых шардов (MANIFEST)
+    Если в папке уже есть шарды, новые дописываются к ним: нумерация продолжается.
+    В одну папку могут одновременно писать несколько процессов: номер шарда выбирается,
+    а MANIFEST обновляется под блокировкой папки (LOCK_FILE)
+    """
+
+    def __init__(self, folder, shard_bytes=64 * 1024 ** 2):
+        """
+        :param folder: папка, куда пишутся шарды
+        :param shard_bytes: размер блока пикселей, после которого начинается новый шард
+        """
+        self.folder = folder
+        self.shard_bytes = shard_bytes
+        self._file = None
+        self.number = None  # номер текущего шарда
+        if not os.path.exists(folder):
+            os.makedirs(folder, exist_ok=True)
+
+    def _path(self, n, suffix):
+        return os.path.join(self.folder, 'shard_%05d%s' % (n, suffix))
+
+    def _open(self):
+        with _folder_lock(self.folder):
+            # номер берется после всех файлов папки, включая недописанный шард прерванной записи
+            # и шарды, которые сейчас пишут другие процессы; созданный файл занимает номер
+            numbers = [int(m.group(1)) for m in map(SHARD_NAME.match, os.listdir(self.folder)) if m]
+            self.number = max(numbers) + 1 if numbers else 0
+            self._file = open(self._path(self.number, '.bin'), 'xb')
+        self._index, self._labels, self._images = [], [], []
+        self._offset = 0
+
+    def _flush(self):
+        self._file.close()
+        np.save(self._path(self.number, '.idx.npy'), np.array(self._index, dtype=INDEX_DTYPE))
+        with open(self._path(self.number, '.labels.json'), 'w', encoding='utf-8') as file:
+            json.dump({'labels': self._labels, 'images': self._images}, file, ensure_ascii=False)
+        # шард попадает в MANIFEST только целиком записанным; список перечитывается под блокировкой,
+        # чтобы не потерять шарды, добавленные другими процессами
+        with _folder_lock(self.folder):
+            names = _existing_shards(self.folder)
+            if 'shard_%05d' % self.number not in names:  # в папке без MANIFEST шард уже найден по файлам
+                names.append('shard_%05d' % self.number)
+            _write_manifest(self.folder, names)
+        self._file = None
+
+    def add(self, img, label, gender, image=''):
+        """
+        :param img: фрагмент (ndarray uint8, оттенки серого)
+        :param label: текст на фрагменте
+        :param gender: пол заполнившего лист
+        :param image: исходный путь фрагмента (нужен для обратной конвертации)
+        """
+        if self._file is None:
+            self._open()
+        img = np.ascontiguousarray(img, dtype=np.uint8)
+        self._file.write(img.data)
+        self._index.append((self._offset, img.shape[0], img.shape[1], gender))
+        self._labels.append(label)
+        self._images.append(image)
+        self._offset += img.nbytes
+        if self._offset >= self.shard_bytes:
+            self._flush()
+
+    def close(self):
+        if self._file is not None:
+            self._flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ShardReader:
+    """
+    Чтение шардов через mmap: фрагменты возвращаются как представления numpy
+    без копирования (только для чтения)
+    """
+
+    def __init__(self, folder):
+        """
+        :param folder: папка с шардами
+        """
+        self.shards = []
+        for name in _existing_shards(folder):
+            prefix = os.path.join(folder, name)
+            index = np.load(prefix + '.idx.npy')
+            with open(prefix + '.labels.json', encoding='utf-8') as file:
+                meta = json.load(file)
+            pixels = np.memmap(prefix + '.bin', dtype=np.uint8, mode='r') if len(index) else None
+            self.shards.append((pixels, index, meta['labels'], meta['images']))
+        # сквозная нумерация фрагментов по всем шардам
+        self._starts = np.cumsum([0] + [len(s[1]) for s in self.shards])
+
+    def __len__(self):
+        return int(self._starts[-1])
+
+    def __getitem__(self, i):
+        """
+        :param i: номер фрагмента
+        :return: (фрагмент, текст, пол)
+        """
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        n = int(np.searchsorted(self._starts, i, side='right')) - 1
+        pixels, index, labels, images = self.shards[n]
+        k = i - self._starts[n]
+        offset, height, width, gender = index[k]
+        img = pixels[offset:offset + int(height) * int(width)].reshape(height, width)
+        return img, labels[k], int(gender)
+
+    def image_path(self, i):
+        n = int(np.searchsorted(self._starts, i, side='right')) - 1
+        return self.shards[n][3][i - self._starts[n]]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+def from_markup(markup_files, folder, shard_bytes=64 * 1024 ** 2):
+    """
+    Упаковка существующей разметки (markup/markup_*.csv + sliced/) в шарды
+    :param markup_files: пути к csv-файлам разметки (label, image, gender)
+    :param folder: папка для шардов
+    :param shard_bytes: размер блока пикселей одного шарда
+    :return: количество упакованных фрагментов
+    """
+    cnt = 0
+    with ShardWriter(folder, shard_bytes) as writer:
+        for markup_file in markup_files:
+            with open(markup_file, newline='') as file:
+                for row in csv.DictReader(file):
+                    img = cv2.imread(row['image'], cv2.IMREAD_GRAYSCALE)
+                    if img is None:
+                        raise Exception("Не удалось прочитать файл %s" % row['image'])
+                    writer.add(img, row['label'], int(row['gender']), row['image'])
+                    cnt += 1
+    return cnt
+
+
+def to_markup(folder, image_root, markup_file):
+    """
+    Обратная конвертация: фрагменты из шардов записываются файлами по исходным путям
+    внутри image_root, а разметка - в csv того же формата, что у write_markup
+    :param folder: папка с шардами
+    :param image_root: корень, относительно которого восстанавливаются пути фрагментов
+    :param markup_file: путь к csv-файлу разметки
+    :return: количество записанных фрагментов
+    """
+    reader = ShardReader(folder)
+    with open(markup_file, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(('label', 'image', 'gender'))
+        for i in range(len(reader)):
+            img, label, gender = reader[i]
+            image = reader.image_path(i) or './sliced/shards/%06d.png' % i
+            path = os.path.join(image_root, image)
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            if not cv2.imwrite(path, img):
+                raise Exception("Не удалось сохранить файл %s" % path)
+            writer.writerow((label, image, gender))
+    return len(reader)
+
+
+if __name__ == '__main__':
+    # интерпретатор должен быть запущен в корневой папке проекта!
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    pack = subparsers.add_parser('pack', help='Упаковать разметку и нарезанные картинки в шарды (дописываются к шардам папки)')
+    pack.add_argument('markup', nargs='+', help='csv-файлы разметки (markup/markup_*.csv)')
+    pack.add_argument('-o', '--output', default='./shards', help='Папка для шардов')
+    pack.add_argument('--shard-mb', type=int, default=64, help='Размер шарда в МБ')
+    unpack = subparsers.add_parser('unpack', help='Распаковать шарды обратно в картинки и csv')
+    unpack.add_argument('shards', help='Папка с шардами')
+    unpack.add_argument('-o', '--output', default='.', help='Корень для восстановленных картинок')
+    unpack.add_argument('--markup', default='./markup/markup_shards.csv', help='Куда записать разметку')
+    args = parser.parse_args()
+
+    if args.command == 'pack':
+        print("Упаковано фрагментов: %d" % from_markup(args.markup, args.output, args.shard_mb * 1024 ** 2))
+    else:
+        print("Распаковано фрагментов: %d" % to_markup(args.shards, args.output, args.markup))
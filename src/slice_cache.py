@@ -0,0 +1,147 @@
+import os
+import json
+import hashlib
+
+import numpy as np
+
+_caches = {}
+
+
+def _digest(obj):
+    return hashlib.sha1(json.dumps(obj, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class SliceCache:
+    """
+    Кэш нарезки, адресуемый содержимым: ключ - хэш исходного скана и параметров нарезки.
+    Для каждого ключа хранятся найденные ячейки и изображение без линий таблицы (без сжатия:
+    вырезать из него ячейки быстрее, чем кодировать и декодировать сами фрагменты),
+    а для каждой папки с результатами - манифест, по которому видно, какие файлы уже актуальны
+    """
+
+    def __init__(self, folder='./cache', max_bytes=1024 ** 3):
+        """
+        :param folder: папка кэша
+        :param max_bytes: предельный размер кэша, сверх которого удаляются давно не использованные записи
+        """
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.entries = os.path.join(folder, 'entries')
+        self.manifests = os.path.join(folder, 'manifests')
+        for path in (self.entries, self.manifests):
+            if not os.path.exists(path):
+                os.makedirs(path, exist_ok=True)
+
+    @staticmethod
+    def key(image_bytes, params):
+        """
+        :param image_bytes: содержимое файла скана
+        :param params: параметры нарезки (словарь, сериализуемый в json)
+        :return: ключ записи
+        """
+        h = hashlib.sha1(image_bytes)
+        h.update(_digest(params).encode('ascii'))
+        return h.hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.entries, key + '.npz')
+
+    def load(self, key):
+        """
+        :param key: ключ записи
+        :return: (массив ячеек (N, 6), изображение без линий таблицы) или None, если записи нет
+        """
+        path = self._entry_path(key)
+        try:
+            with np.load(path) as data:
+                cells, bitnot = data['cells'], data['bitnot']
+        except (OSError, ValueError, KeyError):
+            return None
+        os.utime(path)  # время изменения служит меткой последнего использования
+        return cells, bitnot
+
+    def store(self, key, cells, bitnot):
+        """
+        Сохраняет ячейки и изображение без линий таблицы (npz без сжатия)
+        :param key: ключ записи
+        :param cells: массив ячеек (N, 6)
+        :param bitnot: изображение без линий таблицы (ndarray uint8)
+        """
+        path = self._entry_path(key)
+        tmp_path = path + '.%d.tmp' % os.getpid()
+        with open(tmp_path, 'wb') as file:
+            np.savez(file, cells=np.asarray(cells, dtype=int), bitnot=bitnot)
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def evict(self):
+        """
+        Удаляет давно не использованные записи, пока кэш не уложится в max_bytes
+        """
+        entries = []
+        for filename in os.listdir(self.entries):
+            path = os.path.join(self.entries, filename)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for mtime, size, path in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def _manifest_path(self, folder):
+        name = hashlib.sha1(os.path.normpath(folder).encode('utf-8')).hexdigest()
+        return os.path.join(self.manifests, name + '.json')
+
+    def read_manifest(self, folder):
+        """
+        :param folder: папка с нарезанными изображениями
+        :return: манифест вида {'source': ключ, 'files': {имя файла: хэш настроек обработки}}
+        """
+        try:
+            with open(self._manifest_path(folder), encoding='utf-8') as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {'source': None, 'files': {}}
+
+    def write_manifest(self, folder, manifest):
+        path = self._manifest_path(folder)
+        tmp_path = path + '.%d.tmp' % os.getpid()
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump(manifest, file, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def is_current(manifest, folder, filename, key, settings):
+        """
+        Проверяет, что файл уже записан из того же скана с теми же настройками обработки
+        """
+        return (manifest['source'] == key
+                and manifest['files'].get(filename) == _digest(settings)
+                and os.path.exists(os.path.join(folder, filename)))
+
+    @staticmethod
+    def mark(manifest, filename, key, settings):
+        if manifest['source'] != key:
+            manifest['source'] = key
+            manifest['files'] = {}
+        manifest['files'][filename] = _digest(settings)
+
+
+def open_cache(folder='./cache', max_bytes=1024 ** 3):
+    """
+    Кэш нарезки, общий для всех вызовов внутри процесса
+    :param folder: папка кэша
+    :param max_bytes: предельный размер кэша
+    :return: SliceCache
+    """
+    if folder not in _caches:
+        _caches[folder] = SliceCache(folder, max_bytes)
+    return _caches[folder]
@@ -0,0 +1,141 @@
+import os
+import json
+import argparse
+
+import cv2
+import numpy as np
+
+# размер листа A4 в дюймах
+A4 = (8.27, 11.69)
+
+
+def _stroke(rng, x0, x1, y, amplitude):
+    """
+    Ломаная, похожая на рукописную строку: сглаженное случайное блуждание по вертикали
+    """
+    n = max(8, (x1 - x0) // 12)
+    xs = np.linspace(x0, x1, n)
+    walk = np.cumsum(rng.normal(0, 1, n))
+    walk = np.convolve(walk - walk.mean(), np.ones(5) / 5, mode='same')
+    ys = y + walk / (np.abs(walk).max() + 1e-9) * amplitude
+    # вертикальные «буквы» - частые колебания поверх основной линии
+    ys += np.sin(np.linspace(0, n * rng.uniform(1.5, 2.5), n)) * amplitude * 0.6
+    return np.column_stack((xs, ys)).astype(np.int32)
+
+
+def render_form(dpi=300, rows=20, cols=2, seed=None, noise=6.0, angle=0.0, line_gray=0, handwriting=True):
+    """
+    Синтетический заполненный бланк: таблица rows x cols на листе A4, в левом столбце печатный
+    текст, в правом - рукописные штрихи
+    :param dpi: разрешение скана
+    :param rows: число строк таблицы
+    :param cols: число столбцов таблицы
+    :param seed: зерно генератора случайных чисел
+    :param noise: СКО гауссова шума
+    :param angle: поворот листа в градусах
+    :param line_gray: яркость линий таблицы (0 - черные, больше - бледнее)
+    :param handwriting: рисовать рукописные штрихи
+    :return: (изображение uint8, массив (rows * cols, 4) из x, y, w, h - внутренние области ячеек
+             в порядке строк, затем столбцов)
+    """
+    rng = np.random.default_rng(seed)
+    width, height = int(A4[0] * dpi), int(A4[1] * dpi)
+    img = np.full((height, width), 255, dtype=np.uint8)
+    thickness = max(2, dpi // 100)
+
+    left, right = int(0.08 * width), int(0.92 * width)
+    top, bottom = int(0.12 * height), int(0.85 * height)
+    xs = np.linspace(left, right, cols + 1).astype(int)
+    ys = np.linspace(top, bottom, rows + 1).astype(int)
+    for y in ys:
+        cv2.line(img, (left, y), (right, y), line_gray, thickness)
+    for x in xs:
+        cv2.line(img, (x, top), (x, bottom), line_gray, thickness)
+
+    # внутренняя часть ячейки - между линиями (cv2.line рисует линию симметрично вокруг координаты)
+    half = thickness // 2 + 1
+    boxes = []
+    for r in range(rows):
+        for c in range(cols):
+            x, y = xs[c] + half, ys[r] + half
+            boxes.append([x, y, xs[c + 1] - half - x, ys[r + 1] - half - y])
+    boxes = np.array(boxes, dtype=int)
+
+    scale = dpi / 300
+    for r in range(rows):
+        x, y, w, h = boxes[r * cols]
+        cv2.putText(img, 'phrase %d' % r, (x + int(20 * scale), y + int(h * 0.7)),
+                    cv2.FONT_HERSHEY_SIMPLEX, 1.6 * scale, 0, max(1, int(3 * scale)))
+        if handwriting:
+            for c in range(1, cols):
+                x, y, w, h = boxes[r * cols + c]
+                pts = _stroke(rng, x + int(w * 0.05), x + int(w * rng.uniform(0.4, 0.9)), y + h // 2, h * 0.2)
+                cv2.polylines(img, [pts], False, int(rng.integers(0, 60)), max(1, int(3 * scale)))
+
+    if angle:
+        center = (width / 2, height / 2)
+        matrix = cv2.getRotationMatrix2D(center, angle, 1.0)
+        img = cv2.warpAffine(img, matrix, (width, height), flags=cv2.INTER_LINEAR, borderValue=255)
+        # истинные ячейки - описанные прямоугольники повернутых ячеек
+        corners = np.stack([boxes[:, [0, 1]], boxes[:, [0, 1]] + boxes[:, [2, 3]] * [1, 0],
+                            boxes[:, [0, 1]] + boxes[:, [2, 3]] * [0, 1], boxes[:, [0, 1]] + boxes[:, [2, 3]]], axis=1)
+        moved = corners @ matrix[:, :2].T + matrix[:, 2]
+        lo, hi = moved.min(axis=1), moved.max(axis=1)
+        boxes = np.rint(np.column_stack((lo, hi - lo))).astype(int)
+
+    if noise:
+        img = np.clip(img + rng.normal(0, noise, img.shape), 0, 255).astype(np.uint8)
+    return img, boxes
+
+
+def match_boxes(found, truth):
+    """
+    Сопоставление найденных ячеек с истинными
+    :param found: массив (N, 4) или (N, 6) найденных ячеек (последние 4 столбца - x, y, w, h)
+    :param truth: массив (M, 4) истинных ячеек
+    :return: словарь: сколько истинных ячеек найдено (IoU > 0.8), лишние ячейки,
+             максимальное расхождение координат у найденных (в пикселях)
+    """
+    found = np.asarray(found, dtype=float).reshape(-1, np.shape(found)[-1] if len(found) else 4)[:, -4:]
+    truth = np.asarray(truth, dtype=float)
+    if len(found) == 0:
+        return {'matched': 0, 'truth': len(truth), 'extra': 0, 'max_error': None}
+    # IoU всех пар сразу
+    x1 = np.maximum(truth[:, None, 0], found[None, :, 0])
+    y1 = np.maximum(truth[:, None, 1], found[None, :, 1])
+    x2 = np.minimum(truth[:, None, 0] + truth[:, None, 2], found[None, :, 0] + found[None, :, 2])
+    y2 = np.minimum(truth[:, None, 1] + truth[:, None, 3], found[None, :, 1] + found[None, :, 3])
+    inter = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    union = (truth[:, 2] * truth[:, 3])[:, None] + (found[:, 2] * found[:, 3])[None, :] - inter
+    iou = inter / union
+    best = iou.argmax(axis=1)
+    ok = iou[np.arange(len(truth)), best] > 0.8
+    errors = np.abs(found[best[ok]] - truth[ok])
+    return {'matched': int(ok.sum()), 'truth': len(truth), 'extra': int(len(found) - len(set(best[ok]))),
+            'max_error': float(errors.max()) if len(errors) else None}
+
+
+if __name__ == '__main__':
+    # интерпретатор должен быть запущен в корневой папке проекта!
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-o", "--output", default='./data/synth', help='Папка для синтетических сканов')
+    parser.add_argument("-n", "--count", type=int, default=10, help='Сколько бланков сгенерировать')
+    parser.add_argument("--dpi", type=int, default=300, help='Разрешение')
+    parser.add_argument("--angle", type=float, default=0.5, help='Максимальный поворот листа, градусы')
+    parser.add_argument("--seed", type=int, default=0, help='Зерно генератора')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.output):
+        os.makedirs(args.output)
+    rng = np.random.default_rng(args.seed)
+    truth = {}
+    for page in range(1, args.count + 1):
+        img, boxes = render_form(args.dpi, seed=args.seed + page, angle=rng.uniform(-args.angle, args.angle),
+                                 line_gray=int(rng.integers(0, 120)))
+        # имена в формате batch.py: <страница>_<пол>.png
+        name = '%d_%d.png' % (page, rng.integers(0, 2))
+        cv2.imwrite(os.path.join(args.output, name), img)
+        truth[name] = boxes.tolist()
+    with open(os.path.join(args.output, 'truth.json'), 'w') as file:
+        json.dump(truth, file)
+    print("Сгенерировано бланков: %d" % args.count)
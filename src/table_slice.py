@@ -1,6 +1,14 @@
 import cv2
 import numpy as np
 
+import cell_grid
+
+# ядро морфологической обработки нарезанных ячеек
+CELL_KERNEL = cv2.getStructuringElement(cv2.MORPH_RECT, (2, 1))
+# способы интерполяции при масштабировании ячеек
+INTERPOLATION = {'nearest': cv2.INTER_NEAREST, 'linear': cv2.INTER_LINEAR, 'cubic': cv2.INTER_CUBIC,
+                 'area': cv2.INTER_AREA, 'lanczos': cv2.INTER_LANCZOS4}
+
 
 def binarize(img):
     """
@@ -12,22 +20,54 @@ def binarize(img):
     return img_bin
 
 
-def get_lines(orig_img, bin_img):
+def get_lines(orig_img, bin_img, levels=0):
     """
     Получить вертикальные и горизонтальные границы ячеек
     :param  orig_img: исходное изображение (ndarray)
             bin_img: бинаризованное изображение (ndarray)
+            levels: число уровней пирамиды. При levels > 0 дорогие морфологические операции
+                    выполняются на копии, уменьшенной в 2 ** levels раз, а найденные линии
+                    переносятся обратно в полное разрешение (точность - около 2 ** levels пикселей).
+                    Надежность зависит от размера печатного текста относительно ядра (ширина // 200):
+                    в уменьшенной копии его штрихи могут сойти за линии. На синтетических бланках
+                    (benchmark.py) сетка находится целиком при 300 dpi для levels 1-2, при 400
+                    и 600 dpi - только для levels 1; pipeline.find_cells в этом случае повторяет
+                    поиск в полном разрешении
     :return:    img_vh: изображение из полученных границ на белом фоне (ndarray),
                 bitnot: исходное изображение без полученных границ (ndarray)
     """
+    if levels > 0:
+        scale = 1 / 2 ** levels  # целый коэффициент уменьшения - у INTER_AREA для него быстрый путь
+        # после INTER_AREA тонкие линии становятся серыми, поэтому бинаризуем заново
+        # с низким порогом, чтобы не потерять бледные границы
+        small = cv2.resize(bin_img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        thresh, small = cv2.threshold(small, 64, 255, cv2.THRESH_BINARY)
+        img_vh = _find_lines(small)
+        img_vh = cv2.resize(img_vh, (bin_img.shape[1], bin_img.shape[0]), interpolation=cv2.INTER_NEAREST)
+    else:
+        img_vh = _find_lines(bin_img)
+    # Ядро 2x2
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (2, 2))
+    # Постобработка изображения (всегда в полном разрешении, чтобы толщина линий не зависела от масштаба)
+    img_vh = cv2.erode(~img_vh, kernel, iterations=2)
+    thresh, img_vh = cv2.threshold(img_vh, 128, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    bitxor = cv2.bitwise_xor(orig_img, img_vh)
+    bitnot = cv2.bitwise_not(bitxor)
+    return img_vh, bitnot
+
+
+def _find_lines(bin_img):
+    """
+    Выделение линий таблицы морфологическими операциями
+    :param bin_img: бинаризованное изображение (ndarray)
+    :return: вертикальные и горизонтальные линии, сложенные с одинаковыми весами (ndarray)
+    """
     # Размер ядра
-    kernel_len = np.array(orig_img).shape[1] // 200
+    kernel_len = np.array(bin_img).shape[1] // 200
     # Определение вертикальных линий
     ver_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (1, kernel_len))
     # Определение горизонтальных линий
     hor_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (kernel_len, 1))
-    # Ядро 2x2
-    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (2, 2))
     # Получим новое изображение с вертикальными линиями
     ver_image = cv2.erode(bin_img, ver_kernel, iterations=3)
     vertical_lines = cv2.dilate(ver_image, ver_kernel, iterations=3)
@@ -36,13 +76,31 @@ def get_lines(orig_img, bin_img):
     horizontal_lines = cv2.dilate(hor_image, hor_kernel, iterations=3)
     # Комбинируем вертикальные и горизонтальные линии в ноеое изображение,
     # присваивая им одинаковые веса
-    img_vh = cv2.addWeighted(vertical_lines, 0.5, horizontal_lines, 0.5, 0.0)
-    # Постобработка изображения
-    img_vh = cv2.erode(~img_vh, kernel, iterations=2)
-    thresh, img_vh = cv2.threshold(img_vh, 128, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
-    bitxor = cv2.bitwise_xor(orig_img, img_vh)
-    bitnot = cv2.bitwise_not(bitxor)
-    return img_vh, bitnot
+    return cv2.addWeighted(vertical_lines, 0.5, horizontal_lines, 0.5, 0.0)
+
+
+def check_pyramid(orig_img, levels, tol=None, backend='grid'):
+    """
+    Сверка ячеек, найденных в уменьшенном масштабе, с ячейками полного разрешения
+    :param orig_img: исходное изображение (ndarray)
+    :param levels: проверяемое число уровней пирамиды
+    :param tol: допуск в пикселях (по умолчанию - 2 ** levels + 1)
+    :param backend: способ разбора сетки ячеек
+    :return: (совпадают ли ячейки, максимальное расхождение координат в пикселях)
+    """
+    if tol is None:
+        tol = 2 ** levels + 1
+    img_bin = binarize(orig_img)
+    # строки и столбцы legacy-разбора зависят от порядка контуров, поэтому ячейки
+    # сопоставляются по сетке, восстановленной из самих прямоугольников
+    full = cell_grid.build_grid(get_cells(get_lines(orig_img, img_bin)[0], img_bin, backend)[:, 2:])
+    small = cell_grid.build_grid(get_cells(get_lines(orig_img, img_bin, levels)[0], img_bin, backend)[:, 2:])
+    if full.shape != small.shape or not np.array_equal(full[:, :2], small[:, :2]):
+        return False, None
+    if len(full) == 0:
+        return True, 0
+    max_diff = int(np.abs(full[:, 2:] - small[:, 2:]).max())
+    return max_diff <= tol, max_diff
 
 
 def sort_contours(cnts, method="left-to-right"):
@@ -70,31 +128,20 @@ def sort_contours(cnts, method="left-to-right"):
     return cnts, bounding_boxes
 
 
-def get_images(img_vh, bitnot, img_bin, w_min, h_min, h_max, debug=False):
+def find_boxes(img_vh, img_bin, debug=False):
     """
-    Функция выполняет основную работу по выделению сегментов таблицы (ячеек) на изображении
-    :param img_vh:  считанные границы таблицы (проще говоря, пустая таблица на белом фоне)
-                    все изображения представляют собой двумерный массив numpy
-    :param bitnot:  изображение с вырезанными границами таблицы
+    Поиск прямоугольников ячеек по изображению границ таблицы
+    :param img_vh:  считанные границы таблицы
     :param img_bin: исходное изображение в черно-белом формате
-    :param w_min:   не дает считать слишком маленькие контуры (побочка).
-                    чем больше - тем более мелкие контуры допустимы. параметр для горизонтельных линий
-    :param h_min:   то же, только для вертикальных линий
-    :param h_max:   то же, только для слишком больших вертикальных линий
-                    (дабы не считало за ячейку всю таблицу, к примеру)
-    :param debug:   включает режим отладки - функция тогда
-                    возвращает массив с границами для их визуальной оценки
-    :return:        список сегментов изображения (ячейки таблицы)
+    :param debug:   нарисовать найденные границы на img_bin (изображение изменяется)
+    :return:        список [x, y, w, h], отсортированный сверху вниз, и средняя высота всех контуров
     """
     # Определение и сортировка контуров
-    bitnot = 255 - bitnot
-    # img_vh = 255 - img_vh
     contours, hierarchy = cv2.findContours(img_vh, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
     contours, bounding_boxes = sort_contours(contours, method="top-to-bottom")
     heights = [bounding_boxes[i][3] for i in range(len(bounding_boxes))]
     mean = np.mean(heights)
 
-    image_h, image_w = img_bin.shape
     # Create list box to store all boxes in
     box = []
     # Get position (x,y), width and height for every contour and show the contour on image
@@ -102,16 +149,19 @@ def get_images(img_vh, bitnot, img_bin, w_min, h_min, h_max, debug=False):
         x, y, w, h = cv2.boundingRect(c)
         # if w > (image_w // w_min) and (image_h // h_min) < h < (image_h // h_max):
         if w > 100 and 500 > h > 50:
-            image = cv2.rectangle(img_bin, (x, y), (x + w, y + h), (255, 0, 0), 20)
+            if debug:
+                cv2.rectangle(img_bin, (x, y), (x + w, y + h), (255, 0, 0), 20)
             box.append([x, y, w, h])
+    return box, mean
 
-    # режим отладки возвращает массив с границами для их визуальной оценки
-    if debug:
-        try:
-            return image
-        except UnboundLocalError:
-            print("Границ не найдено")
 
+def _legacy_grid(box, mean):
+    """
+    Исходная раскладка ячеек по строкам и столбцам (циклы на python)
+    :param box: список [x, y, w, h], отсортированный сверху вниз
+    :param mean: средняя высота контуров
+    :return: массив int (N, 6) из row, col, x, y, w, h
+    """
     # Создаем два списка для хранения строки и столбца, где расположены ячейки
     rows = []
     column = []
@@ -160,45 +210,173 @@ def get_images(img_vh, bitnot, img_bin, w_min, h_min, h_max, debug=False):
             lis[indexing].append(rows[i][j])
         finalboxes.append(lis)
 
-    cropped_images = []
+    cells = []
     for i in range(len(finalboxes)):
         for j in range(len(finalboxes[i])):
-            if len(finalboxes[i][j]) != 0:
-                for k in range(len(finalboxes[i][j])):
-                    y, x, w, h = finalboxes[i][j][k][0], finalboxes[i][j][k][1], finalboxes[i][j][k][2], \
-                                 finalboxes[i][j][k][3]
-                    finalimg = bitnot[x:x + h, y:y + w]
-                    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (2, 1))
-                    border = cv2.copyMakeBorder(finalimg, 2, 2, 2, 2, cv2.BORDER_CONSTANT, value=[255, 255])
-                    resizing = cv2.resize(border, None, fx=2, fy=2, interpolation=cv2.INTER_CUBIC)
-                    dilation = cv2.dilate(resizing, kernel, iterations=1)
-                    erosion = cv2.erode(dilation, kernel, iterations=1)
-                    cropped_images.append(255 - erosion)
+            for k in range(len(finalboxes[i][j])):
+                cells.append([i, j] + list(finalboxes[i][j][k]))
+    return np.array(cells, dtype=int).reshape(-1, 6)
+
+
+def get_cells(img_vh, img_bin, backend='legacy'):
+    """
+    Определение ячеек таблицы и их положения в сетке
+    :param img_vh:  считанные границы таблицы
+    :param img_bin: исходное изображение в черно-белом формате
+    :param backend: 'legacy' - исходный разбор циклами, 'grid' - векторный разбор cell_grid
+                    (устойчив к строкам с пропущенными и объединенными ячейками)
+    :return:        массив int (N, 6) из row, col, x, y, w, h в порядке нарезки
+    """
+    box, mean = find_boxes(img_vh, img_bin)
+    if backend == 'grid':
+        return cell_grid.build_grid(box)
+    if backend == 'legacy':
+        return _legacy_grid(box, mean)
+    raise ValueError("Неизвестный способ разбора сетки: %s" % backend)
 
+
+def crop_cells(bitnot, cells, scale=2, interpolation='cubic', border=2):
+    """
+    Вырезает ячейки из изображения и подготавливает их к сохранению: черная рамка,
+    масштабирование и размыкание светлого фона (замыкает разрывы в темных штрихах)
+    Все ячейки скана обрабатываются вместе: ядро и промежуточные буферы общие,
+    результат пишется сразу на место в один непрерывный блок памяти
+    :param bitnot: изображение с вырезанными границами таблицы (как возвращает get_lines)
+    :param cells:  массив (N, 6) из row, col, x, y, w, h
+    :param scale:  коэффициент увеличения (1 - без масштабирования)
+    :param interpolation: способ интерполяции при масштабировании (ключ INTERPOLATION)
+    :param border: ширина рамки до масштабирования
+    :return:       список сегментов изображения (ячейки таблицы) - непрерывные представления
+                   одного общего массива uint8
+    """
+    cells = np.asarray(cells, dtype=int).reshape(-1, 6)
+    if len(cells) == 0:
+        return []
+    heights = cells[:, cell_grid.H] + 2 * border
+    widths = cells[:, cell_grid.W] + 2 * border
+    # размер результата считается так же, как в cv2.resize с fx, fy (округление к ближайшему четному)
+    out_heights = np.rint(heights * scale).astype(int) if scale != 1 else heights
+    out_widths = np.rint(widths * scale).astype(int) if scale != 1 else widths
+    offsets = np.concatenate(([0], np.cumsum(out_heights * out_widths)))
+    packed = np.empty(offsets[-1], dtype=np.uint8)
+    bordered = np.empty(int((heights * widths).max()), dtype=np.uint8)
+    scaled = np.empty(int((out_heights * out_widths).max()), dtype=np.uint8)
+
+    cropped_images = []
+    for (row, col, x, y, w, h), bh, bw, oh, ow, start in zip(cells, heights, widths, out_heights, out_widths,
+                                                               offsets):
+        # раньше ячейка инвертировалась, замыкалась и инвертировалась обратно:
+        # это то же самое, что размыкание без инверсий с черной рамкой вместо белой
+        src = cv2.copyMakeBorder(bitnot[y:y + h, x:x + w], border, border, border, border, cv2.BORDER_CONSTANT,
+                                 dst=bordered[:bh * bw].reshape(bh, bw), value=0)
+        if scale != 1:
+            src = cv2.resize(src, (int(ow), int(oh)), dst=scaled[:oh * ow].reshape(oh, ow),
+                             interpolation=INTERPOLATION[interpolation])
+        out = packed[start:start + oh * ow].reshape(oh, ow)
+        cv2.morphologyEx(src, cv2.MORPH_OPEN, CELL_KERNEL, dst=out)
+        cropped_images.append(out)
     return cropped_images
 
 
-def control(answers, cropped_images, nocheck=False):
+def get_images(img_vh, bitnot, img_bin, w_min, h_min, h_max, debug=False, backend='legacy', printed=False):
+    """
+    Функция выполняет основную работу по выделению сегментов таблицы (ячеек) на изображении
+    :param img_vh:  считанные границы таблицы (проще говоря, пустая таблица на белом фоне)
+                    все изображения представляют собой двумерный массив numpy
+    :param bitnot:  изображение с вырезанными границами таблицы
+    :param img_bin: исходное изображение в черно-белом формате
+    :param w_min:   не дает считать слишком маленькие контуры (побочка).
+                    чем больше - тем более мелкие контуры допустимы. параметр для горизонтельных линий
+    :param h_min:   то же, только для вертикальных линий
+    :param h_max:   то же, только для слишком больших вертикальных линий
+                    (дабы не считало за ячейку всю таблицу, к примеру)
+    :param debug:   включает режим отладки - функция тогда
+                    возвращает массив с границами для их визуальной оценки
+    :param backend: способ разбора сетки ячеек: 'legacy' или 'grid' (см. get_cells)
+    :param printed: нарезать и печатные ячейки (по умолчанию - только рукописные,
+                    роль ячейки определяется ее столбцом, см. cell_grid.cell_roles)
+    :return:        список сегментов изображения (ячейки таблицы)
+    """
+    # режим отладки возвращает массив с границами для их визуальной оценки
+    if debug:
+        box, mean = find_boxes(img_vh, img_bin, debug=True)
+        if not box:
+            print("Границ не найдено")
+            return None
+        return img_bin
+
+    cells = get_cells(img_vh, img_bin, backend)
+    if not printed:
+        cells = cells[cell_grid.cell_roles(cells) == cell_grid.HANDWRITTEN]
+    return crop_cells(bitnot, cells)
+
+
+def make_mosaic(images, scale=0.2, gap=4):
+    """
+    Контрольная мозаика: каждое изображение сначала уменьшается, затем
+    уменьшенные копии выкладываются столбиком на заранее выделенный холст
+    :param images: изображения (ndarray uint8)
+    :param scale: коэффициент уменьшения
+    :param gap: промежуток между изображениями на холсте
+    :return: холст (ndarray uint8)
+    """
+    sizes = [(max(1, round(img.shape[1] * scale)), max(1, round(img.shape[0] * scale))) for img in images]
+    if not sizes:
+        return np.full((1, 1), 255, dtype=np.uint8)
+    height = sum(h for w, h in sizes) + gap * (len(sizes) - 1)
+    width = max(w for w, h in sizes)
+    canvas = np.full((height, width), 255, dtype=np.uint8)
+    y = 0
+    for img, (w, h) in zip(images, sizes):
+        canvas[y:y + h, :w] = cv2.resize(img, (w, h), interpolation=cv2.INTER_AREA)
+        y += h + gap
+    return canvas
+
+
+def inspect_cells(images, expected=None, ink_level=128, empty=0.002, saturated=0.5, aspect=(2.0, 40.0)):
+    """
+    Автоматическая проверка нарезанных ячеек
+    :param images: рукописные ячейки (ndarray uint8, чернила темные)
+    :param expected: ожидаемое число ячеек
+    :param ink_level: пиксели темнее этого уровня считаются чернилами
+    :param empty: доля чернил, ниже которой ячейка считается пустой
+    :param saturated: доля чернил, выше которой ячейка считается залитой
+    :param aspect: допустимый диапазон отношения ширины к высоте
+    :return: список замечаний (пустой, если все в порядке)
+    """
+    issues = []
+    if expected is not None and len(images) != expected:
+        issues.append("число ячеек %d вместо %d" % (len(images), expected))
+    for idx, img in enumerate(images):
+        ink = np.count_nonzero(img < ink_level) / img.size
+        ratio = img.shape[1] / img.shape[0]
+        if ink < empty:
+            issues.append("ячейка %d пустая" % idx)
+        elif ink > saturated:
+            issues.append("ячейка %d залита чернилами (%.0f%%)" % (idx, ink * 100))
+        if not aspect[0] <= ratio <= aspect[1]:
+            issues.append("ячейка %d: странные пропорции %dx%d" % (idx, img.shape[1], img.shape[0]))
+    return issues
+
+
+def control(answers, handwritten, nocheck=False, path='control.png'):
     """
     Проверка корректности формирования разметки
     :param answers: тексты (словосочетания)
-    :param cropped_images: соответствующие им изображения (массивы numpy)
-    :param nocheck: не запрашивать подтверждение записи в файл
-    :return:
-    """
-    assert 2 * len(answers) == len(cropped_images)
-    min_dims = np.array([1e8, 1e8], dtype=int)
-    for idx, arr in enumerate(cropped_images):
-        if idx % 2 == 1:
-            min_dims = np.minimum(min_dims, arr.shape)
-    concat = []
-    for idx, arr in enumerate(cropped_images):
-        if idx % 2 == 1:
-            concat.append(arr[:min_dims[0], :min_dims[1]])
-    stack = np.vstack(concat)
-    showme = cv2.resize(stack, (0, 0), fx=0.2, fy=0.2)
-    did_write = cv2.imwrite('control.png', showme)
+    :param handwritten: соответствующие им рукописные ячейки (массивы numpy)
+    :param nocheck: не запрашивать подтверждение записи в файл (автоматическая проверка)
+    :param path: куда записать контрольную мозаику из рукописных ячеек
+    :return: список замечаний по скану (пустой, если все в порядке)
+    """
+    issues = inspect_cells(handwritten, expected=len(answers))
+    did_write = cv2.imwrite(path, make_mosaic(handwritten))
+    if not did_write:
+        issues.append("не удалось записать %s" % path)
     if not nocheck:
+        assert len(answers) == len(handwritten)
         assert did_write
+        for issue in issues:
+            print(issue)
         print("Контрольный файл записан")
         input("Проверь файл, нажми кнопку \n")
+    return issues
@@ -0,0 +1,205 @@
+import os
+import hashlib
+
+import cv2
+import numpy as np
+
+# размер уменьшенной копии скана, по которой сравниваются бланки (пропорции A4)
+THUMB_SIZE = (512, 724)
+# во сколько раз уменьшается маска линий при проверке перенесенной сетки
+SUPPORT_FACTOR = 4
+
+_registries = {}
+
+
+def _thumbnail(img):
+    """
+    Уменьшенная копия изображения линий таблицы для глобального выравнивания
+    :param img: линии таблицы, темные на белом фоне (img_vh из table_slice.get_lines)
+    :return: float32 копия размера THUMB_SIZE, линии - положительные значения
+    """
+    # сначала уменьшаем в целое число раз (быстрый путь INTER_AREA), затем подгоняем до нужного размера
+    factor = max(1, img.shape[1] // THUMB_SIZE[0])
+    small = cv2.resize(img, None, fx=1 / factor, fy=1 / factor, interpolation=cv2.INTER_AREA)
+    small = cv2.resize(small, THUMB_SIZE, interpolation=cv2.INTER_LINEAR)
+    return (255 - small).astype(np.float32)
+
+
+def _line_mask(img_vh):
+    """
+    Уменьшенная в SUPPORT_FACTOR раз маска линий таблицы, расширенная на пиксель:
+    допускает расхождение перенесенной сетки с линиями на несколько пикселей
+    """
+    small = cv2.resize(255 - img_vh, None, fx=1 / SUPPORT_FACTOR, fy=1 / SUPPORT_FACTOR,
+                       interpolation=cv2.INTER_AREA)
+    return cv2.dilate((small > 0).astype(np.uint8), np.ones((3, 3), np.uint8))
+
+
+def grid_support(img_vh, cells, samples=16):
+    """
+    Доля точек на границах ячеек, лежащих на линиях таблицы
+    Сетка другого макета (другое число строк или столбцов) проходит мимо части линий
+    :param img_vh: линии таблицы, темные на белом фоне
+    :param cells: массив (N, 6) из row, col, x, y, w, h
+    :param samples: число точек на каждой стороне ячейки
+    :return: доля от 0 до 1
+    """
+    if len(cells) == 0:
+        return 0.0
+    mask = _line_mask(img_vh)
+    t = (np.arange(samples) + 0.5) / samples
+    x, y, w, h = (np.asarray(cells, dtype=float)[:, i, None] for i in range(2, 6))
+    along_x, along_y = x + t * w, y + t * h
+    # линии лежат сразу за границей ячейки: сверху, снизу, слева и справа
+    xs = np.concatenate([along_x, along_x, np.repeat(x - 1, samples, 1), np.repeat(x + w, samples, 1)], axis=1)
+    ys = np.concatenate([np.repeat(y - 1, samples, 1), np.repeat(y + h, samples, 1), along_y, along_y], axis=1)
+    ix = np.clip((xs // SUPPORT_FACTOR).astype(int), 0, mask.shape[1] - 1)
+    iy = np.clip((ys // SUPPORT_FACTOR).astype(int), 0, mask.shape[0] - 1)
+    return float(mask[iy, ix].mean())
+
+
+def same_grid(a, a_shape, b, b_shape, tol=0.01):
+    """
+    Совпадают ли сетки ячейка в ячейку с точностью до сдвига листа
+    :param a, b: массивы (N, 6) из row, col, x, y, w, h
+    :param a_shape, b_shape: размеры изображений, на которых найдены сетки
+    :param tol: допуск в долях ширины изображения a
+    """
+    a, b = np.asarray(a, dtype=float), np.asarray(b, dtype=float)
+    if a.shape != b.shape or not np.array_equal(a[:, :2], b[:, :2]):
+        return False
+    b = b.copy()
+    b[:, [2, 4]] *= a_shape[1] / b_shape[1]
+    b[:, [3, 5]] *= a_shape[0] / b_shape[0]
+    diff = a[:, 2:] - b[:, 2:]
+    diff[:, :2] -= np.median(diff[:, :2], axis=0)  # общий сдвиг листа не считается различием
+    return bool(np.abs(diff).max() <= tol * a_shape[1])
+
+
+class TemplateRegistry:
+    """
+    Реестр бланков: для каждого встреченного макета хранится сетка ячеек,
+    чтобы повторные сканы того же бланка не проходили поиск контуров заново
+    Бланки сравниваются по маске линий таблицы (img_vh), а не по самому скану:
+    рукописный и печатный текст различаются от листа к листу и мешают выравниванию.
+    Отклик фазовой корреляции у разных макетов с общей рамкой тоже высокий, поэтому
+    перенесенная сетка дополнительно проверяется по линиям (grid_support)
+    """
+
+    def __init__(self, folder='./templates', min_confidence=0.1, min_support=0.95, expected_cells=40):
+        """
+        :param folder: папка, где хранятся шаблоны (по одному npz на макет)
+        :param min_confidence: минимальный отклик фазовой корреляции, при котором шаблон проверяется
+        :param min_support: минимальная доля границ перенесенной сетки, лежащих на линиях
+        :param expected_cells: сколько ячеек должно быть в бланке (20 строк x 2 столбца).
+                               Сетки с другим числом ячеек в реестр не попадают
+        """
+        self.folder = folder
+        self.min_confidence = min_confidence
+        self.min_support = min_support
+        self.expected_cells = expected_cells
+        self.templates = {}
+        self._window = cv2.createHanningWindow(THUMB_SIZE, cv2.CV_32F)
+        self._mtime = None
+        self.refresh()
+
+    def refresh(self):
+        """
+        Перечитывает папку с шаблонами, если ее содержимое изменилось
+        (шаблоны могут добавлять другие процессы)
+        """
+        if not os.path.isdir(self.folder):
+            return
+        mtime = os.stat(self.folder).st_mtime
+        if mtime == self._mtime:
+            return
+        self._mtime = mtime
+        for filename in os.listdir(self.folder):
+            name, ext = os.path.splitext(filename)
+            if ext == '.npz' and name not in self.templates:
+                with np.load(os.path.join(self.folder, filename)) as data:
+                    if 'lines' not in data:
+                        continue  # шаблон старого формата (по самому скану) - не сравним
+                    self.templates[name] = (data['lines'], data['cells'], tuple(data['shape']))
+
+    def match(self, img_vh):
+        """
+        Ищет подходящий шаблон и переносит его сетку на скан
+        :param img_vh: линии таблицы скана, темные на белом фоне (table_slice.get_lines)
+        :return: (массив ячеек (N, 6) из row, col, x, y, w, h или None, доля границ на линиях)
+        """
+        self.refresh()
+        if not self.templates:
+            return None, 0.0
+        thumb = _thumbnail(img_vh)
+        candidates = []
+        for name, (tmpl_thumb, cells, shape) in self.templates.items():
+            (dx, dy), response = cv2.phaseCorrelate(tmpl_thumb, thumb, self._window)
+            if response >= self.min_confidence:
+                candidates.append((response, cells, shape, dx, dy))
+        best, best_support = None, 0.0
+        for response, cells, shape, dx, dy in sorted(candidates, key=lambda c: -c[0]):
+            moved = self._transfer(img_vh.shape, cells, shape, dx, dy)
+            support = grid_support(img_vh, moved)
+            if support > best_support:
+                best, best_support = moved, support
+            if support >= self.min_support:
+                return moved, support
+        return None, best_support
+
+    @staticmethod
+    def _transfer(img_shape, cells, shape, dx, dy):
+        """
+        Переносит сетку шаблона в координаты скана: масштаб по размерам, затем сдвиг
+        """
+        height, width = img_shape[:2]
+        moved = cells.astype(float)
+        moved[:, [2, 4]] *= width / shape[1]
+        moved[:, [3, 5]] *= height / shape[0]
+        moved[:, 2] += dx * width / THUMB_SIZE[0]
+        moved[:, 3] += dy * height / THUMB_SIZE[1]
+        moved = np.rint(moved).astype(int)
+        # ячейки не должны выходить за границы изображения
+        moved[:, 2] = np.clip(moved[:, 2], 0, width - 1)
+        moved[:, 3] = np.clip(moved[:, 3], 0, height - 1)
+        moved[:, 4] = np.minimum(moved[:, 4], width - moved[:, 2])
+        moved[:, 5] = np.minimum(moved[:, 5], height - moved[:, 3])
+        return moved
+
+    def add(self, img_vh, cells):
+        """
+        Сохраняет сетку нового макета
+        :param img_vh: линии таблицы скана, темные на белом фоне (table_slice.get_lines)
+        :param cells: массив ячеек (N, 6) из row, col, x, y, w, h
+        :return: имя шаблона или None, если сетка не похожа на бланк или такой макет уже есть
+        """
+        if self.expected_cells is not None and len(cells) != self.expected_cells:
+            return None
+        self.refresh()
+        # скан известного бланка, не прошедший проверку (например, из-за наклона), реестр не пополняет
+        for tmpl_cells, shape in ((t[1], t[2]) for t in self.templates.values()):
+            if same_grid(cells, img_vh.shape, tmpl_cells, shape):
+                return None
+        thumb = _thumbnail(img_vh)
+        name = 'template_' + hashlib.sha1(np.asarray(cells).tobytes()).hexdigest()[:12]
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder)
+        # запись через временный файл, чтобы другие процессы не прочитали недописанный шаблон
+        path = os.path.join(self.folder, name + '.npz')
+        tmp_path = path + '.%d.tmp' % os.getpid()
+        with open(tmp_path, 'wb') as file:
+            np.savez(file, lines=thumb, cells=np.asarray(cells, dtype=int), shape=np.array(img_vh.shape))
+        os.replace(tmp_path, path)
+        self.templates[name] = (thumb, np.asarray(cells, dtype=int), img_vh.shape)
+        return name
+
+
+def open_registry(folder='./templates'):
+    """
+    Реестр шаблонов, общий для всех вызовов внутри процесса
+    :param folder: папка с шаблонами
+    :return: TemplateRegistry
+    """
+    if folder not in _registries:
+        _registries[folder] = TemplateRegistry(folder)
+    return _registries[folder]
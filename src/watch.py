@@ -0,0 +1,327 @@
+import os
+import json
+import time
+import signal
+import argparse
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import markup
+from batch import parse_scan_name, init_worker, run_one, write_qa_report
+from main import SOURCES, add_slice_args, slice_options
+
+# расширения сканов, которые можно описать файлом <скан>.json с полями page и gender
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.tif', '.tiff', '.bmp')
+
+
+def read_task(source, folder, filename):
+    """
+    Задание на нарезку для нового файла: страница и пол берутся из файла-описания
+    <имя скана>.json ({"page": 12, "gender": 1}), а если его нет - из имени файла (batch.SCAN_NAME)
+    :param source: название файла с текстом (подпапка data/images)
+    :param folder: папка со сканом
+    :param filename: имя файла скана
+    :return: кортеж (labels, images, page, gender) или None, если файл не скан или описания нет
+    """
+    stem, ext = os.path.splitext(filename)
+    if ext.lower() not in IMAGE_EXTENSIONS:
+        return None
+    sidecar = os.path.join(folder, stem + '.json')
+    if os.path.exists(sidecar):
+        try:
+            with open(sidecar, encoding='utf-8') as file:
+                meta = json.load(file)
+            return source, filename, int(meta['page']), int(meta['gender'])
+        except (OSError, ValueError, KeyError, TypeError):
+            return None  # описание еще дописывается или испорчено - попробуем на следующем обходе
+    parsed = parse_scan_name(filename)
+    return None if parsed is None else (source, filename) + parsed
+
+
+class Watcher:
+    """
+    Демон непрерывной нарезки: обходит data/images/<source>/, ставит новые сканы в очередь
+    и нарезает их на пуле заранее запущенных процессов
+    Очередь ограничена: пока она полна, новые файлы не принимаются и будут найдены следующими обходами.
+    Упавшие сканы повторяются с растущей задержкой, состояние пишется в json-файл.
+    Если процесс пула погибает (segfault в opencv, OOM), пул запускается заново,
+    а сканы, которые были в работе, возвращаются в очередь как упавшие
+    """
+
+    def __init__(self, root='./data/images', sources=SOURCES, workers=None, cv_threads=1, queue_size=64,
+                 interval=5.0, retries=3, retry_delay=10.0, status_path='watch_status.json',
+                 state_path='watch_state.json', qa_report='qa_report.csv', **options):
+        """
+        :param root: папка с исходными (сканированными) изображениями
+        :param sources: какие подпапки обходить
+        :param workers: число процессов (по умолчанию - по числу ядер)
+        :param cv_threads: число потоков opencv в каждом процессе
+        :param queue_size: предельная длина очереди (включая сканы в работе)
+        :param interval: период обхода папок, в секундах
+        :param retries: сколько раз повторять упавший скан
+        :param retry_delay: задержка перед первым повтором (дальше удваивается), в секундах
+        :param status_path: куда писать состояние демона
+        :param state_path: где хранить список уже нарезанных файлов (переживает перезапуск)
+        :param qa_report: куда дописывать замечания автоматической проверки сканов (batch.write_qa_report)
+        :param options: параметры нарезки, передаваемые в slice_scan (backend, levels, templates, cache)
+        """
+        self.root = root
+        self.sources = sources
+        self.workers = workers or os.cpu_count() or 1
+        self.cv_threads = cv_threads
+        self.queue_size = max(queue_size, self.workers)
+        self.interval = interval
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.status_path = status_path
+        self.state_path = state_path
+        self.qa_report = qa_report
+        self.options = options
+
+        self.queue = deque()  # (задание, попытка, не раньше какого времени запускать)
+        self.running = {}  # future -> (задание, попытка, путь, отпечаток файла)
+        self.queued = set()  # пути в очереди и в работе
+        self.unstable = {}  # путь -> отпечаток на прошлом обходе (файл может еще копироваться)
+        self.done_files = self._load_state()  # путь -> отпечаток нарезанного файла
+        self.failed = {}  # путь -> (отпечаток, последняя ошибка) после всех повторов
+        self.recent = deque(maxlen=1000)  # время завершения сканов для расчета пропускной способности
+        self.done, self.retried, self.flagged = 0, 0, 0
+        self.started = time.time()
+        self.stopping = False
+        self.broken = False  # пул процессов сломан и должен быть запущен заново
+        self._lock = threading.Lock()
+        self._status = {}
+
+    def _load_state(self):
+        try:
+            with open(self.state_path, encoding='utf-8') as file:
+                return {path: tuple(fp) for path, fp in json.load(file).items()}
+        except (OSError, ValueError):
+            return {}
+
+    def _save_state(self):
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump(self.done_files, file, ensure_ascii=False)
+        os.replace(tmp_path, self.state_path)
+
+    def poll(self):
+        """
+        Обход папок: файл попадает в очередь, когда его размер и время изменения
+        не поменялись с прошлого обхода (сканер закончил запись)
+        """
+        for source in self.sources:
+            folder = os.path.join(self.root, source)
+            if not os.path.isdir(folder):
+                continue
+            for filename in sorted(os.listdir(folder)):
+                if len(self.queue) + len(self.running) >= self.queue_size:
+                    return  # очередь полна - остальное подождет
+                path = os.path.join(folder, filename)
+                if path in self.queued:
+                    continue
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                fingerprint = (stat.st_size, stat.st_mtime_ns)
+                # упавший скан пробуется снова, только если файл заменили
+                if self.done_files.get(path) == fingerprint or self.failed.get(path, (None,))[0] == fingerprint:
+                    continue
+                if self.unstable.get(path) != fingerprint:
+                    self.unstable[path] = fingerprint
+                    continue
+                task = read_task(source, folder, filename)
+                if task is None:
+                    continue
+                del self.unstable[path]
+                self.queue.append((task, 0, 0.0))
+                self.queued.add(path)
+
+    def _submit(self, pool):
+        now = time.time()
+        for _ in range(len(self.queue)):
+            if len(self.running) >= self.workers:
+                break
+            task, attempt, not_before = self.queue.popleft()
+            if not_before > now:
+                self.queue.append((task, attempt, not_before))  # повтор еще рано запускать
+                continue
+            path = os.path.join(self.root, task[0], task[1])
+            try:
+                stat = os.stat(path)
+            except OSError:
+                self.queued.discard(path)  # файл удалили, пока он ждал в очереди
+                continue
+            # отпечаток берется до нарезки: если файл перезапишут во время работы, его нарежут снова
+            try:
+                future = pool.submit(run_one, task, self.options, False)
+            except BrokenProcessPool:
+                self.queue.appendleft((task, attempt, not_before))
+                self.broken = True
+                break
+            self.running[future] = (task, attempt, path, (stat.st_size, stat.st_mtime_ns))
+
+    def _collect(self, finished, sources):
+        for future in finished:
+            task, attempt, path, fingerprint = self.running.pop(future)
+            try:
+                task, issues, error, records = future.result()
+            except BaseException as e:  # процесс пула упал целиком (BrokenProcessPool) или задание отменено
+                issues, error = [], '%s: %s' % (type(e).__name__, e)
+                # виновника не узнать: попытку теряют все сканы, бывшие в работе, зато
+                # скан, который роняет процесс, не будет повторяться бесконечно
+                self.broken |= isinstance(e, BrokenProcessPool)
+            if error is None:
+                self.done += 1
+                if issues:
+                    self.flagged += 1
+                    write_qa_report(self.qa_report, [(task, issues)], append=True)
+                self.recent.append(time.time())
+                self.done_files[path] = fingerprint
+                self.failed.pop(path, None)
+                self.queued.discard(path)
+                sources.add(task[0])
+            elif attempt < self.retries:
+                self.retried += 1
+                self.queue.append((task, attempt + 1, time.time() + self.retry_delay * 2 ** attempt))
+                print("Повтор %d: %s/%s - %s" % (attempt + 1, task[0], task[1], error))
+            else:
+                self.failed[path] = (fingerprint, error)
+                self.queued.discard(path)
+                print("Ошибка: %s/%s - %s" % (task[0], task[1], error))
+
+    def status(self):
+        """
+        :return: словарь состояния: длина очереди, сканы в работе, нарезано, ошибки,
+                 пропускная способность за последние 10 минут (сканов в минуту)
+        """
+        now = time.time()
+        window = min(600.0, now - self.started) or 1.0
+        return {'updated': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(now)),
+                'uptime': round(now - self.started, 1), 'queued': len(self.queue), 'running': len(self.running),
+                'done': self.done, 'retried': self.retried, 'flagged': self.flagged,
+                'failed': len(self.failed), 'scans_per_minute': round(
+                    sum(1 for t in self.recent if t > now - window) / window * 60, 2),
+                'failures': [{'image': path, 'error': error} for path, (fp, error) in sorted(self.failed.items())]}
+
+    def write_status(self):
+        status = self.status()
+        with self._lock:
+            self._status = status
+        tmp_path = self.status_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump(status, file, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, self.status_path)
+
+    def serve(self, port):
+        """
+        Отдает состояние демона в json по http://127.0.0.1:<port>/ (в отдельном потоке)
+        """
+        watcher = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                with watcher._lock:
+                    body = json.dumps(watcher._status, ensure_ascii=False).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+    def _start_pool(self):
+        return ProcessPoolExecutor(max_workers=self.workers, initializer=init_worker, initargs=(self.cv_threads,))
+
+    def stop(self, *args):
+        self.stopping = True
+
+    def run(self):
+        """
+        Основной цикл: обход, запуск заданий, сбор результатов, выгрузка csv разметки
+        и запись состояния. Останавливается по Ctrl+C или SIGTERM, дождавшись сканов в работе
+        """
+        signal.signal(signal.SIGTERM, self.stop)
+        next_poll = 0.0
+        pool = self._start_pool()
+        try:
+            while not self.stopping or self.running:
+                if not self.stopping and time.time() >= next_poll:
+                    self.poll()
+                    next_poll = time.time() + self.interval
+                if not self.stopping:
+                    self._submit(pool)
+                sources = set()
+                if self.running:
+                    finished, _ = wait(list(self.running), timeout=1.0, return_when=FIRST_COMPLETED)
+                    self._collect(finished, sources)
+                else:
+                    time.sleep(min(1.0, self.interval))
+                if self.broken:
+                    # все задания сломанного пула завершаются с BrokenProcessPool и возвращаются в очередь
+                    print("Процесс пула аварийно завершился, пул запускается заново")
+                    pool.shutdown(wait=False, cancel_futures=True)
+                    finished, _ = wait(list(self.running))
+                    self._collect(finished, sources)
+                    pool = self._start_pool()
+                    self.broken = False
+                # csv разметки выгружается из хранилища после каждой порции нарезанных сканов
+                for source in sorted(sources):
+                    markup.export_markup(source)
+                if sources:
+                    self._save_state()
+                self.write_status()
+        except KeyboardInterrupt:
+            # процессы пула Ctrl+C игнорируют (init_worker) и дописывают начатые сканы
+            self.stopping = True
+            finished, _ = wait(list(self.running))
+            sources = set()
+            self._collect(finished, sources)
+            for source in sorted(sources):
+                markup.export_markup(source)
+        finally:
+            # состояние сохраняется при любом выходе, чтобы после перезапуска не резать сканы повторно
+            self._save_state()
+            self.write_status()
+            pool.shutdown()
+
+
+if __name__ == '__main__':
+    # интерпретатор должен быть запущен в корневой папке проекта!
+    # демон сам находит новые сканы в data/images/<source>/ и нарезает их;
+    # страница и пол - из имени <страница>_<пол>.<расширение> или из файла <скан>.json
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sources", nargs='+', choices=SOURCES, default=SOURCES,
+                        help='Какие подпапки data/images отслеживать')
+    parser.add_argument("-j", "--workers", type=int, default=None, help="Число процессов (по умолчанию - по числу ядер)")
+    parser.add_argument("--cv-threads", type=int, default=1, help="Число потоков opencv в каждом процессе")
+    parser.add_argument("--interval", type=float, default=5.0, help="Период обхода папок, с")
+    parser.add_argument("--queue-size", type=int, default=64, help="Предельная длина очереди")
+    parser.add_argument("--retries", type=int, default=3, help="Сколько раз повторять упавший скан")
+    parser.add_argument("--retry-delay", type=float, default=10.0, help="Задержка перед первым повтором, с")
+    parser.add_argument("--status", default='watch_status.json', help="Куда писать состояние демона")
+    parser.add_argument("--qa-report", default='qa_report.csv',
+                        help="Куда дописывать замечания автоматической проверки сканов")
+    parser.add_argument("--port", type=int, default=None,
+                        help="Отдавать состояние по http://127.0.0.1:<port>/")
+    add_slice_args(parser)
+    args = parser.parse_args()
+
+    watcher = Watcher(sources=args.sources, workers=args.workers, cv_threads=args.cv_threads,
+                      queue_size=args.queue_size, interval=args.interval, retries=args.retries,
+                      retry_delay=args.retry_delay, status_path=args.status,
+                      qa_report=args.qa_report, **slice_options(args))
+    if args.port:
+        watcher.serve(args.port)
+    print("Отслеживаются папки %s/{%s}, остановка - Ctrl+C" % (watcher.root, ','.join(args.sources)))
+    watcher.run()
@@ -0,0 +1,83 @@
+import os
+import sys
+
+import cv2
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import enhance  # noqa: E402
+
+
+def old_increase_contrast(img, erode=True):
+    """
+    Прежняя обработка (markup.increase_contrast до переноса в enhance): растяжение контраста
+    и эрозия во float64, перевод в uint8 - при записи файла (cvRound с насыщением, nan -> 0)
+    """
+    pxmin = np.min(img)
+    pxmax = np.max(img)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        img_contrast = (img - pxmin) / (pxmax - pxmin) * 255
+    if erode:
+        img_contrast = cv2.erode(img_contrast, np.ones((3, 3), np.uint8), iterations=1)
+    # значения неотрицательны, поэтому взятие модуля ничего не меняет
+    return cv2.convertScaleAbs(img_contrast)
+
+
+def random_cell(seed, shape=(57, 213), low=0, high=256):
+    rng = np.random.default_rng(seed)
+    return rng.integers(low, high, size=shape, dtype=np.uint8)
+
+
+@pytest.mark.parametrize('seed', range(5))
+@pytest.mark.parametrize('erode', [True, False])
+def test_matches_old_formula(seed, erode):
+    img = random_cell(seed)
+    assert np.array_equal(enhance.increase_contrast(img, erode), old_increase_contrast(img, erode))
+
+
+@pytest.mark.parametrize('low, high', [(0, 3), (10, 13), (100, 105), (200, 256), (37, 38)])
+def test_matches_old_formula_narrow_range(low, high):
+    # при узком диапазоне много значений попадает ровно на .5 - проверяется округление к четному
+    img = random_cell(low, low=low, high=high)
+    assert np.array_equal(enhance.increase_contrast(img), old_increase_contrast(img))
+
+
+@pytest.mark.parametrize('value', [0, 128, 255])
+def test_constant_image(value):
+    img = np.full((20, 30), value, dtype=np.uint8)
+    result = enhance.increase_contrast(img)
+    assert result.dtype == np.uint8
+    assert np.array_equal(result, old_increase_contrast(img))
+    assert not result.any()
+
+
+@pytest.mark.parametrize('pad', [1, 2, 5])
+def test_pad_white_image(pad):
+    # ячейки из table_slice.crop_cells уже окружены белой рамкой, поэтому максимум - 255
+    # и поля Enhancer совпадают с рамкой, добавленной до прежней обработки
+    img = random_cell(pad)
+    img[0, 0] = 255
+    bordered = cv2.copyMakeBorder(img, pad, pad, pad, pad, cv2.BORDER_CONSTANT, value=255)
+    assert np.array_equal(enhance.increase_contrast(img, pad=pad), old_increase_contrast(bordered))
+
+
+@pytest.mark.parametrize('pad', [1, 3])
+def test_pad_dark_image(pad):
+    # максимум ниже 255: растяжение считается по самой ячейке, а поля после него белые
+    img = random_cell(10 + pad, low=20, high=180)
+    contrast = (img - float(img.min())) / (float(img.max()) - float(img.min())) * 255
+    contrast = cv2.copyMakeBorder(contrast, pad, pad, pad, pad, cv2.BORDER_CONSTANT, value=255)
+    expected = cv2.convertScaleAbs(cv2.erode(contrast, np.ones((3, 3), np.uint8)))
+    result = enhance.increase_contrast(img, pad=pad)
+    assert result.shape == (img.shape[0] + 2 * pad, img.shape[1] + 2 * pad)
+    assert np.array_equal(result, expected)
+
+
+def test_enhancer_reuses_buffers():
+    # результаты не зависят от предыдущих вызовов с другими размерами
+    enhancer = enhance.Enhancer(pad=2)
+    for seed, shape in enumerate([(80, 300), (20, 40), (57, 213), (80, 300)]):
+        img = random_cell(seed, shape)
+        assert np.array_equal(enhancer(img), enhance.increase_contrast(img, pad=2))
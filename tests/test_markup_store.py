@@ -0,0 +1,85 @@
+import csv
+import os
+import sys
+from multiprocessing import Pool
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import markup  # noqa: E402
+import markup_store  # noqa: E402
+
+
+@pytest.fixture
+def project(tmp_path, monkeypatch):
+    # markup.append_markup работает с ./markup относительно корня проекта
+    monkeypatch.chdir(tmp_path)
+    yield tmp_path
+    for store in markup_store._stores.values():
+        store.close()
+    markup_store._stores.clear()
+
+
+def scan_rows(page, n=20, label='фраза'):
+    return [('%s %d' % (label, i), './sliced/econ/%d_1/%03d.jpg' % (page, 2 * i + 1), 1) for i in range(n)]
+
+
+def read_csv(path):
+    with open(path, newline='') as file:
+        return list(csv.reader(file))
+
+
+def test_readding_scan_replaces_rows(project):
+    with markup_store.MarkupStore('markup/markup.db') as store:
+        store.add('econ', 1, scan_rows(1))
+        store.add('econ', 2, scan_rows(2))
+        assert store.count('econ') == 40
+        # повторная нарезка скана: те же пути, исправленные тексты
+        store.add('econ', 1, scan_rows(1, label='исправлено'))
+        assert store.count('econ') == 40
+        assert store.count('econ', page=1) == 20
+        assert all(label.startswith('исправлено') for label, image, gender in store.rows('econ', page=1))
+
+
+def test_legacy_csv_imported_once(project):
+    os.makedirs('markup')
+    legacy = [('старая %d' % i, './sliced/econ/old/%03d.jpg' % i, 0) for i in range(3)]
+    with open('markup/markup_econ.csv', 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(('label', 'image', 'gender'))
+        writer.writerows(legacy)
+
+    markup.append_markup('econ', 1, scan_rows(1))
+    store = markup_store.open_store()
+    assert store.count('econ') == 23
+    assert store.count('econ', gender=0) == 3
+    # csv еще не выгружен, но прежние строки уже в хранилище и второй раз не загружаются
+    markup.append_markup('econ', 1, scan_rows(1))
+    assert store.count('econ') == 23
+
+
+def test_export_csv(project):
+    markup.append_markup('econ', 2, scan_rows(2, 2))
+    markup.append_markup('econ', 1, scan_rows(1, 2))
+    markup.append_markup('journ', 1, scan_rows(5, 1))
+    assert markup.export_markup('econ') == 4
+    rows = read_csv('markup/markup_econ.csv')
+    assert rows[0] == ['label', 'image', 'gender']
+    # строки идут по страницам, а не в порядке добавления
+    assert [row[1] for row in rows[1:]] == [image for label, image, gender in scan_rows(1, 2) + scan_rows(2, 2)]
+    assert not [name for name in os.listdir('markup') if name.endswith('.tmp')]
+
+
+def _add_scan(page):
+    store = markup_store.open_store()
+    store.add('econ', page, scan_rows(page))
+    return store.count('econ')
+
+
+def test_concurrent_writers(project):
+    # процессы пула пишут в одну базу одновременно, каждый - своим соединением
+    with Pool(4) as pool:
+        pool.map(_add_scan, list(range(1, 13)) * 2)
+    with markup_store.MarkupStore('markup/markup.db') as store:
+        assert store.count('econ') == 12 * 20
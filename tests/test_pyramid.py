@@ -0,0 +1,41 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import cell_grid  # noqa: E402
+import pipeline  # noqa: E402
+import synth  # noqa: E402
+import table_slice as ts  # noqa: E402
+
+
+@pytest.mark.parametrize('dpi, levels', [(300, 1), (300, 2), (600, 1)])
+@pytest.mark.parametrize('backend', ['grid', 'legacy'])
+def test_pyramid_matches_full_resolution(dpi, levels, backend):
+    # проверенный диапазон из документации get_lines: ячейки совпадают с точностью 2 ** levels + 1 пикселей
+    img, _ = synth.render_form(dpi, seed=3)
+    ok, max_diff = ts.check_pyramid(img, levels, backend=backend)
+    assert ok, max_diff
+
+
+def test_pyramid_outside_tested_range_falls_back():
+    # при 600 dpi и levels=2 штрихи печатного текста сходят за линии - сетка неполная,
+    # и find_cells повторяет поиск линий в полном разрешении
+    img, _ = synth.render_form(600, seed=3)
+    assert not ts.check_pyramid(img, 2)[0]
+    cells, bitnot = pipeline.find_cells(img, 'grid', levels=2)
+    full, full_bitnot = pipeline.find_cells(img, 'grid', levels=0)
+    assert np.array_equal(cells, full)
+    assert np.array_equal(bitnot, full_bitnot)
+
+
+def test_is_complete():
+    img, _ = synth.render_form(300, seed=1)
+    cells, _ = pipeline.find_cells(img, 'grid')
+    assert cell_grid.is_complete(cells, (20, 2))
+    assert not cell_grid.is_complete(cells[1:], (20, 2))
+    assert not cell_grid.is_complete(cells[cells[:, cell_grid.COL] == 1], (20, 2))
+    assert not cell_grid.is_complete(cells, (40, 1))